@@ -6,11 +6,16 @@ from aiohttp import web
 import sockjs
 
 from anubis import error
+from anubis import template
+from anubis.model import scoreboard
 from anubis.util import options
 from anubis.util import locale
 from anubis.util import json
 from anubis.util import tools
 from anubis.service import bus
+from anubis.service import dbprofile
+from anubis.service import metrics
+from anubis.service import smallcache
 
 options.define('debug', default=False, help='Enable debug mode.')
 options.define('static', default=True, help='Serve static files.')
@@ -19,6 +24,10 @@ options.define('unsaved_session_expire_seconds', default=43200,
                help='Expire time for unsaved session, in seconds.')
 options.define('saved_session_expire_seconds', default=2592000,
                help='Expire time for saved session, in seconds.')
+options.define('session_refresh_ratio', default=0.1,
+               help='Rewrite an unchanged session only after this fraction of its expire time.')
+options.define('compress_min_length', default=1024,
+               help='Compress response bodies of at least this many bytes, 0 to disable.')
 options.define('cookie_domain', default=None, help='Cookie domain.')
 options.define('cookie_secure', default=False, help='Enable secure cookie flag.')
 options.define('registration_token_expire_seconds', default=86400,
@@ -35,11 +44,16 @@ _logger = logging.getLogger(__name__)
 
 class Application(web.Application):
     def __init__(self):
-        super(Application, self).__init__(debug=options.options.debug)
+        super(Application, self).__init__(debug=options.options.debug, middlewares=[metrics.middleware])
         globals()[self.__class__.__name__] = lambda: self
         translation_path = path.join(path.dirname(__file__), 'locale')
         locale.load_translations(translation_path)
-        # TODO: Add small cache.
+        smallcache.init()
+        metrics.init()
+        dbprofile.init()
+        scoreboard.init()
+        if options.options.template_precompile:
+            _logger.info('Precompiled %d templates.', template.get_environment().precompile())
         # TODO: Add Message Queue Register.
         self.loop.run_until_complete(asyncio.gather(
             tools.create_all_indexes(),
@@ -58,6 +72,7 @@ class Application(web.Application):
         from anubis.handler import fs
         from anubis.handler import campaign
         from anubis.handler import student
+        from anubis.handler import monitor
         if options.options.static:
             self.router.add_static(
                 '/', path.join(path.dirname(__file__), '.static_build'), name='static')
@@ -1,5 +1,11 @@
+import collections
+import inspect
+import time
+
 from motor import motor_asyncio
 
+from anubis.service import dbprofile
+from anubis.service import metrics
 from anubis.util import options
 
 options.define('db_host', default='localhost', help='Database hostname or IP address.')
@@ -16,12 +22,97 @@ class Database(object):
         return cls._instance
 
 
+def _instrument(result, query=None):
+    if inspect.isawaitable(result):
+        if query:
+            return dbprofile.profile(result, query)
+        return metrics.observe('mongo', result)
+    if hasattr(result, 'to_list'):
+        return InstrumentedCursor(result, query)
+    return result
+
+
+class InstrumentedCursor(object):
+    """Cursor wrapper which records the time spent waiting for the database.
+
+    With profiling enabled, the query shape, time and number of documents are also recorded when
+    the cursor is exhausted by to_list() or async iteration, or counted by count().
+    """
+
+    # Documents fetched at once by async iteration, which is timed per batch instead of per document.
+    ITER_BATCH_SIZE = 100
+
+    def __init__(self, cursor, query=None):
+        self.cursor = cursor
+        self.query = query
+        self._iterated = False
+        self._seconds = 0.0
+        self._num_docs = 0
+        self._docs = collections.deque()
+
+    def __getattr__(self, name):
+        attr = getattr(self.cursor, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def wrapped(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if result is self.cursor:
+                if name == 'sort' and self.query:
+                    self.query['sort'] = list(args[0]) if len(args) == 1 else [tuple(args)]
+                return self
+            if self.query and name in ('to_list', 'count'):
+                return _instrument(result, dict(self.query, op=name if name == 'count' else self.query['op']))
+            return _instrument(result)
+
+        return wrapped
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._docs:
+            calls, self._iterated = 0 if self._iterated else 1, True
+            start = time.perf_counter()
+            docs = await self.cursor.to_list(self.ITER_BATCH_SIZE)
+            seconds = time.perf_counter() - start
+            metrics.record_call('mongo', seconds, calls)
+            self._seconds += seconds
+            self._num_docs += len(docs)
+            if not docs:
+                if self.query:
+                    dbprofile.record(self.query, self._seconds, self._num_docs)
+                raise StopAsyncIteration
+            self._docs.extend(docs)
+        return self._docs.popleft()
+
+
+class InstrumentedCollection(object):
+    """Collection wrapper which records the time spent waiting for the database."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def wrapped(*args, **kwargs):
+            query = None
+            if options.options.db_profile and name in dbprofile.OPERATIONS:
+                query = dbprofile.get_query(self.collection, name, args, kwargs)
+            return _instrument(attr(*args, **kwargs), query)
+
+        return wrapped
+
+
 class Collection(object):
     _instances = {}
 
     def __new__(cls, name):
         if name not in cls._instances:
-            cls._instances[name] = motor_asyncio.AsyncIOMotorCollection(Database(), name)
+            cls._instances[name] = InstrumentedCollection(motor_asyncio.AsyncIOMotorCollection(Database(), name))
         return cls._instances[name]
 
 
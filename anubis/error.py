@@ -300,6 +300,12 @@ class RecordNotFoundError(NotFoundError):
         return 'Record {0} not found.'
 
 
+class RejudgeJobNotFoundError(NotFoundError):
+    @property
+    def message(self):
+        return 'Rejudge job {0} not found.'
+
+
 class OpCountExceededError(ForbiddenError):
     @property
     def message(self):
@@ -2,6 +2,7 @@ import accept
 import asyncio
 import calendar
 import functools
+import hashlib
 import hmac
 import logging
 import markupsafe
@@ -15,14 +16,15 @@ from anubis import error
 from anubis import template
 from anubis.model import token
 from anubis.model import builtin
-from anubis.model import user
 from anubis.model import domain
 from anubis.model import opcount
+from anubis.model.adaptor import loader
 from anubis.model.adaptor import setting
 from anubis.service import mailer
 from anubis.util import json
 from anubis.util import locale
 from anubis.util import options
+from anubis.util import zipstream
 
 _logger = logging.getLogger(__name__)
 
@@ -32,18 +34,19 @@ class HandlerBase(setting.SettingMixin):
     TITLE = None
 
     async def prepare(self):
+        self.loader = loader.Loader()
         self.session = await self.update_session()
         self.domain_id = self.request.match_info.pop('domain_id', builtin.DOMAIN_ID_SYSTEM)
         if 'uid' in self.session:
             uid = self.session['uid']
             self.user, self.domain, self.domain_user = await asyncio.gather(
-                user.get_by_uid(uid), domain.get(self.domain_id), domain.get_user(self.domain_id, uid)
+                self.loader.get_user(uid), domain.get(self.domain_id),
+                self.loader.get_domain_user(self.domain_id, uid)
             )
             if not self.user:
                 raise error.UserNotFoundError(uid)
             if not self.domain_user:
                 self.domain_user = {}
-            self.user = await user.get_by_uid(self.session['uid']) or builtin.USER_GUEST
         else:
             self.user = builtin.USER_GUEST
             self.domain = await domain.get(self.domain_id)
@@ -100,7 +103,9 @@ class HandlerBase(setting.SettingMixin):
     async def update_session(self, *, new_saved=False, **kwargs):
         """Update or create session if necessary.
 
-        If 'sid' in cookie, the 'expire_at' field is updated.
+        If 'sid' in cookie, the session is rewritten when the extra data changes or the last
+        refresh is older than session_refresh_ratio of the expire time. Cookies are only sent
+        when they change, i.e. on creation or when a saved session is rewritten.
         If 'sid' not in cookie, only create when there is extra data.
 
         Args:
@@ -119,13 +124,15 @@ class HandlerBase(setting.SettingMixin):
         else:
             token_type = token.TYPE_UNSAVED_SESSION
             session_expire_seconds = options.options.unsaved_session_expire_seconds
+        refreshed, created = False, False
         if sid:
-            session = await token.update(sid, token_type, session_expire_seconds,
-                                         **{
-                                             **kwargs,
-                                             'update_ip': self.remote_ip,
-                                             'update_ua': self.request.headers.get('User-Agent')
-                                         })
+            refresh_ratio = 0 if new_saved else options.options.session_refresh_ratio
+            session, refreshed = await token.refresh(sid, token_type, session_expire_seconds, refresh_ratio,
+                                                     **{
+                                                         **kwargs,
+                                                         'update_ip': self.remote_ip,
+                                                         'update_ua': self.request.headers.get('User-Agent')
+                                                     })
         if not session:
             sid, session = await token.add(token_type, session_expire_seconds,
                                            **{
@@ -133,7 +140,8 @@ class HandlerBase(setting.SettingMixin):
                                                'create_ip': self.remote_ip,
                                                'update_ua': self.request.headers.get('User-Agent')
                                            })
-        if session:
+            created = True
+        if session and (created or (save and refreshed)):
             cookie_kwargs = {
                 'domain': options.options.cookie_domain,
                 'secure': options.options.cookie_secure,
@@ -145,7 +153,7 @@ class HandlerBase(setting.SettingMixin):
                 cookie_kwargs['max_age'] = session_expire_seconds
                 self.response.set_cookie('save', '1', **cookie_kwargs)
             self.response.set_cookie('sid', sid, **cookie_kwargs)
-        else:
+        elif not session:
             self.clear_cookies('sid', 'save')
         return session or {}
 
@@ -194,7 +202,7 @@ class HandlerBase(setting.SettingMixin):
             kwargs['path_components'] = self.build_path((self.translate(self.NAME), None))
         kwargs['reverse_url'] = self.reverse_url
         kwargs['datetime_span'] = self.datetime_span
-        return template.Environment().get_template(template_name).render(kwargs)
+        return template.get_environment().get_template(template_name).render(kwargs)
 
 
 class Handler(web.View, HandlerBase):
@@ -218,15 +226,66 @@ class Handler(web.View, HandlerBase):
             _logger.error('Unexpected exception occurred when handling %s (IP = %s, UID = %d): %s',
                           self.url, self.remote_ip, self.user['_id'] or None, repr(e))
             raise
+        if not self.response.prepared:
+            self.finish_response()
         return self.response
 
+    def check_not_modified(self, version):
+        """Tag the response with a handler-provided version key.
+
+        The weak ETag is derived from the version key and the viewer, including the language and
+        timezone pages are rendered in, so that the handler can skip querying and rendering when the
+        client already has this version.
+
+        Args:
+            version: anything whose str() changes whenever the page content changes.
+
+        Returns:
+            True if the client has this version and a 304 response is set.
+        """
+        digest = hashlib.md5(repr((str(version), self.user['_id'], self.domain_id, self.view_lang,
+                                   self.timezone.zone, self.csrf_token,
+                                   self.prefer_json)).encode()).hexdigest()
+        self.response.headers['ETag'] = 'W/"{0}"'.format(digest)
+        if self._etag_matches():
+            self.response.set_status(web.HTTPNotModified.status_code, None)
+            return True
+        return False
+
+    def _etag_matches(self):
+        if self.request.method not in ('GET', 'HEAD'):
+            return False
+        if_none_match = self.request.headers.get('If-None-Match', '')
+        etag = self.response.headers['ETag']
+        return if_none_match == '*' or etag in (tag.strip() for tag in if_none_match.split(','))
+
+    def finish_response(self):
+        """Answer conditional requests and compress the body of the response."""
+        if self.response.status == web.HTTPNotModified.status_code:
+            self.response.body = None
+            return
+        body = self.response.body
+        if self.response.status != web.HTTPOk.status_code or not body:
+            return
+        if 'ETag' not in self.response.headers:
+            self.response.headers['ETag'] = 'W/"{0}"'.format(hashlib.md5(body).hexdigest())
+        if 'Cache-Control' not in self.response.headers:
+            self.response.headers['Cache-Control'] = 'private, no-cache'
+        if self._etag_matches():
+            self.response.set_status(web.HTTPNotModified.status_code, None)
+            self.response.body = None
+            return
+        if 0 < options.options.compress_min_length <= len(body):
+            self.response.headers.add('Vary', 'Accept-Encoding')
+            self.response.enable_compression()
+
     def render(self, template_name, **kwargs):
         self.response.content_type = 'text/html'
         self.response.text = self.render_html(template_name, **kwargs)
 
     def json(self, obj):
         self.response.content_type = 'application/json'
-        self.response.headers.add('Cache-Control', 'no-store, no-cache, must-revalidate')
+        self.response.headers.add('Cache-Control', 'private, no-cache, must-revalidate')
         self.response.text = json.encode(obj)
 
     async def binary(self, data, type='application/octet-stream', *, filename: str=None):
@@ -238,6 +297,19 @@ class Handler(web.View, HandlerBase):
         await self.response.prepare(self.request)
         self.response.write(data)
 
+    async def zip_stream(self, *, filename: str=None):
+        """Start a streaming ZIP response.
+
+        Returns:
+            ZipStreamWriter to write entries into. Close it to finish the response.
+        """
+        self.response = web.StreamResponse()
+        self.response.content_type = 'application/zip'
+        if filename:
+            self.response.headers['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+        await self.response.prepare(self.request)
+        return zipstream.ZipStreamWriter(self.response)
+
     async def send_mail(self, mail, title, template_name, **kwargs):
         content = self.render_html(template_name, url_prefix=options.options.url_prefix, **kwargs)
         await mailer.send_mail(mail, '{0} - SUT Online Judge'.format(self.translate(title)), content)
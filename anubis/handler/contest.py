@@ -1,15 +1,15 @@
 import asyncio
 import calendar
+import collections
 import datetime
 import functools
-import io
 import pytz
-import zipfile
 from bson import objectid
 
 from anubis import app
 from anubis import constant
 from anubis import error
+from anubis import redis
 from anubis.model import builtin
 from anubis.model import opcount
 from anubis.model import record
@@ -17,6 +17,7 @@ from anubis.model import user
 from anubis.model import problem
 from anubis.model import contest
 from anubis.model import discussion
+from anubis.model import scoreboard
 from anubis.handler import base
 from anubis.util import pagination
 from anubis.util import json
@@ -142,27 +143,31 @@ class ContestDetailHandler(base.OperationHandler, ContestStatusMixin):
 
 @app.route('/contest/{tid:\d{4,}}/code', 'contest_code')
 class ContestCodeHandler(base.OperationHandler):
+    CODES_PER_BATCH = 100
+
     @base.require_perm(builtin.PERM_VIEW_CONTEST)
     @base.require_perm(builtin.PERM_READ_RECORD_CODE)
     @base.limit_rate('contest_code', 3600, 60)
     @base.route_argument
     @base.sanitize
     async def get(self, *, tid: int):
-        tdoc, tsdocs = await contest.get_and_list_status(self.domain_id, tid)
+        tdoc = await contest.get(self.domain_id, tid)
         rnames = {}
-        for tsdoc in tsdocs:
+        async for tsdoc in contest.get_multi_status(domain_id=self.domain_id, tid=tdoc['_id'],
+                                                    projection={'uid': 1, 'detail.pid': 1, 'detail.rid': 1}):
             for pdetail in tsdoc.get('detail', []):
                 rnames[pdetail['rid']] = 'U{}_P{}_R{}'.format(tsdoc['uid'], pdetail['pid'], pdetail['rid'])
-        output_buffer = io.BytesIO()
-        zip_file = zipfile.ZipFile(output_buffer, 'a', zipfile.ZIP_DEFLATED)
-        rdocs = record.get_multi(get_hidden=True, _id={'$in': list(rnames.keys())})
-        async for rdoc in rdocs:
-            zip_file.writestr(rnames[rdoc['_id']] + '.' + rdoc['lang'], rdoc['code'])
-        for zfile in zip_file.filelist:
-            zfile.create_system = 0
-        zip_file.close()
-
-        await self.binary(output_buffer.getvalue(), 'application/zip')
+        zip_writer = await self.zip_stream()
+        rdocs = record.get_multi(_id={'$in': list(rnames.keys())},
+                                 projection={'lang': 1, 'code': 1, 'code_id': 1})
+        while True:
+            batch = await rdocs.to_list(self.CODES_PER_BATCH)
+            if not batch:
+                break
+            codes = await record.get_code_dict(batch)
+            for rdoc in batch:
+                await zip_writer.write(rnames[rdoc['_id']] + '.' + rdoc['lang'], codes[rdoc['_id']])
+        await zip_writer.close()
 
 
 @app.route('/contest/{tid:\d{4,}}/{letter:[A-Z]}', 'contest_detail_problem')
@@ -175,19 +180,16 @@ class ContestDetailProblemHandler(base.Handler, ContestStatusMixin):
         uid = self.user['_id'] if self.has_priv(builtin.PRIV_USER_PROFILE) else None
         tdoc = await contest.get(self.domain_id, tid)
         pid = contest.convert_to_pid(tdoc['pids'], letter)
-        pdoc = await problem.get(self.domain_id, pid, uid)
-        if not pdoc:
-            raise error.ProblemNotFoundError(self.domain_id, pid, tdoc['_id'])
+        pdoc, tsdoc, udoc = await asyncio.gather(
+            self.loader.get_problem(self.domain_id, pid, uid, tid=tdoc['_id']),
+            contest.get_status(self.domain_id, tdoc['_id'], self.user['_id']),
+            self.loader.get_user(tdoc['owner_uid']))
         pdoc['letter'] = letter
         if not self.is_done(tdoc):
-            tsdoc = await contest.get_status(self.domain_id, tdoc['_id'], self.user['_id'])
             if not tsdoc or tsdoc.get('attend') != 1:
                 raise error.ContestNotAttendedError(tdoc['_id'])
             if not self.is_live(tdoc):
                 raise error.ContestNotLiveError(tdoc['_id'])
-        tsdoc, udoc = await asyncio.gather(
-            contest.get_status(self.domain_id, tdoc['_id'], self.user['_id']),
-            user.get_by_uid(tdoc['owner_uid']))
         attended = tsdoc and tsdoc.get('attend') == 1
         path_components = self.build_path(
             (self.translate('contest_main'), self.reverse_url('contest_main')),
@@ -201,46 +203,38 @@ class ContestDetailProblemHandler(base.Handler, ContestStatusMixin):
 
 @app.route('/contest/{tid:\d{4,}}/balloon', 'contest_balloon')
 class ContestBalloonHandler(base.OperationHandler, ContestStatusMixin):
+    BALLOONS_PER_PAGE = 200
+
     @base.require_priv(builtin.PRIV_USER_PROFILE)
     @base.require_perm(builtin.PERM_SEND_CONTEST_BALLOON)
+    @base.get_argument
     @base.route_argument
     @base.sanitize
-    async def get(self, *, tid: int):
+    async def get(self, *, tid: int, after: objectid.ObjectId=None):
         tdocs = await contest.get_multi(self.domain_id, **{'begin_at': {'$lte': self.now},
                                                            'end_at': {'$gt': self.now}},
                                         projection={'_id': True}).to_list(None)
-        tids = [tdoc['_id'] for tdoc in tdocs]
         query = {'domain_id': self.domain_id,
-                 'tid': {'$in': list(set(tids))},
-                 'detail.accept': True,
-                 'detail.balloon': False}
-        tsdocs = await contest.get_multi_status(**query).sort('_id', 1).to_list(None)
-        balloons = []
-        for tsdoc in tsdocs:
-            for pstatus in tsdoc['detail']:
-                if pstatus['accept'] and not pstatus['balloon']:
-                    balloons.append({'tid': tsdoc['tid'],
-                                     'uid': tsdoc['uid'],
-                                     'pid': pstatus['pid'],
-                                     'balloon': pstatus['balloon']})
-        udict, udoc, tdoc = await asyncio.gather(
-            user.get_dict([balloon['uid'] for balloon in balloons]),
-            user.get_by_uid(self.user['_id']),
+                 'tid': {'$in': [tdoc['_id'] for tdoc in tdocs]},
+                 'balloon': False}
+        if after:
+            query['_id'] = {'$gt': after}
+        balloons, tdoc = await asyncio.gather(
+            contest.get_multi_balloon(**query).sort('_id', 1).limit(self.BALLOONS_PER_PAGE).to_list(None),
             contest.get(self.domain_id, tid))
-        for balloon in balloons:
-            balloon.update({'uname': udict[balloon['uid']]['uname'],
-                            'nickname': udict[balloon['uid']].get('nickname', ''),
-                            'letter': contest.convert_to_letter(tdoc['pids'], balloon['pid'])})
+        cursor = balloons[-1]['_id'] if len(balloons) == self.BALLOONS_PER_PAGE else None
         if not self.prefer_json:
+            udict, udoc = await asyncio.gather(user.get_dict([tdoc['owner_uid']]),
+                                               user.get_by_uid(self.user['_id']))
             path_components = self.build_path(
                 (self.translate('contest_main'), self.reverse_url('contest_main')),
                 (tdoc['title'], self.reverse_url('contest_detail', tid=tid)),
                 (self.translate('contest_balloon'), None)
             )
             self.render('contest_balloon.html', path_components=path_components,
-                        udict=udict, udoc=udoc, tdoc=tdoc, balloons=balloons)
+                        udict=udict, udoc=udoc, tdoc=tdoc, balloons=balloons, cursor=cursor)
         else:
-            self.json({'balloons': balloons})
+            self.json({'balloons': balloons, 'cursor': cursor})
 
     @base.require_priv(builtin.PRIV_USER_PROFILE)
     @base.require_perm(builtin.PERM_SEND_CONTEST_BALLOON)
@@ -268,7 +262,7 @@ class ContestBalloonHandler(base.OperationHandler, ContestStatusMixin):
 class ContestBalloonConnection(base.Connection):
     @base.require_perm(builtin.PERM_SEND_CONTEST_BALLOON)
     async def on_open(self):
-        bus.subscribe(self.on_message, ['balloon_change'])
+        bus.subscribe(self.on_message, ['balloon_change-' + self.domain_id])
 
     async def on_message(self, e):
         self.send(**json.decode(e['value']))
@@ -277,23 +271,85 @@ class ContestBalloonConnection(base.Connection):
         bus.unsubscribe(self.on_message)
         
 
+class ContestNotificationHub(object):
+    """Fan-out of contest notifications to the notification connections of this worker.
+
+    A changed row is rendered once for each group of connections which see the same row.
+    """
+
+    def __init__(self):
+        self.conns = collections.defaultdict(set)  # tid -> connections
+
+    def _subscribe(self):
+        if self.conns:
+            bus.subscribe(self.on_notification, ['contest_notification-' + str(tid) for tid in self.conns])
+        else:
+            bus.unsubscribe(self.on_notification)
+
+    def add(self, tid, conn):
+        self.conns[tid].add(conn)
+        self._subscribe()
+
+    def remove(self, tid, conn):
+        self.conns[tid].discard(conn)
+        if not self.conns[tid]:
+            del self.conns[tid]
+        self._subscribe()
+
+    async def on_notification(self, e):
+        tid = int(e['key'][len('contest_notification-'):])
+        value = json.decode(e['value'])
+        if value['type'] != 'row_changed':
+            for conn in list(self.conns.get(tid, ())):
+                conn.send(**value)
+            return
+        tsdoc = value['tsdoc']
+        board, udoc = await asyncio.gather(scoreboard.get(tsdoc['domain_id'], tid),
+                                           user.get_by_uid(tsdoc['uid']))
+        rank = next(r['rank'] for r in value['ranks'] if r['uid'] == tsdoc['uid'])
+        template_name = 'partials/contest_status_{0}_tr.html'.format(
+            constant.contest.RULE_ID[board.tdoc['rule']])
+        htmls = {}
+        for conn in list(self.conns.get(tid, ())):
+            if not conn.can_view_status(board.tdoc):
+                continue
+            key = (conn.domain_id, conn.view_lang)
+            if key not in htmls:
+                htmls[key] = conn.render_html(template_name, tdoc=board.tdoc, rank=rank, tsdoc=tsdoc,
+                                              udict={tsdoc['uid']: udoc}, dict=dict)
+            conn.send(**value, html=htmls[key])
+
+
+_contest_notification_hub = ContestNotificationHub()
+
+
 @app.connection_route('/contest/{tid:\d{4,}}/notification-conn', 'contest_notification-conn')
 class ContestNotificationConnection(base.Connection, ContestStatusMixin):
+    # Not set if on_open failed before adding the connection to the hub.
+    tid = None
+
     @base.require_priv(builtin.PRIV_USER_PROFILE)
+    @base.require_perm(builtin.PERM_VIEW_CONTEST)
+    @base.require_perm(builtin.PERM_VIEW_CONTEST_STATUS)
     async def on_open(self):
         await super(ContestNotificationConnection, self).on_open()
         tid = int(self.request.match_info['tid'])
         tdoc = await contest.get(self.domain_id, tid)
         if self.is_done(tdoc):
             raise error.ContestNotLiveError(tid)
-        tsdoc = await contest.get_status(self.domain_id, tid, self.user['_id'])
-        bus.subscribe(self.on_notification, ['contest_notification-' + str(tid)])
+        if not self.can_view_status(tdoc):
+            raise error.ContestStatusHiddenError()
+        _contest_notification_hub.add(tid, self)
+        self.tid = tid
 
-    async def on_notification(self, e):
-        self.send(**json.decode(e['value']))
+    def can_view_status(self, tdoc):
+        # Checked again for each change, as the connection outlives the time it is opened at.
+        return (contest.RULES[tdoc['rule']].show_func(tdoc, datetime.datetime.utcnow())
+                or self.has_perm(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS))
 
     async def on_close(self):
-        bus.unsubscribe(self.on_notification)
+        if self.tid is not None:
+            _contest_notification_hub.remove(self.tid, self)
 
 
 @app.route('/contest/{tid:\d{4,}}/{letter:[A-Z]}/submit', 'contest_detail_problem_submit')
@@ -306,14 +362,11 @@ class ContestDetailProblemSubmitHandler(base.Handler, ContestStatusMixin):
         uid = self.user['_id'] if self.has_priv(builtin.PRIV_USER_PROFILE) else None
         tdoc = await contest.get(self.domain_id, tid)
         pid = contest.convert_to_pid(tdoc['pids'], letter)
-        pdoc = await problem.get(self.domain_id, pid, uid)
-        if not pdoc:
-            raise error.ProblemNotFoundError(self.domain_id, pid, tdoc['_id'])
-        pdoc['letter'] = letter
-        tsdoc, udoc = await asyncio.gather(
+        pdoc, tsdoc, udoc = await asyncio.gather(
+            self.loader.get_problem(self.domain_id, pid, uid, tid=tdoc['_id']),
             contest.get_status(self.domain_id, tdoc['_id'], self.user['_id']),
-            user.get_by_uid(tdoc['owner_uid'])
-        )
+            self.loader.get_user(tdoc['owner_uid']))
+        pdoc['letter'] = letter
         attended = tsdoc and tsdoc.get('attend') == 1
         if (contest.RULES[tdoc['rule']].show_func(tdoc, self.now)
                 or self.has_perm(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS)):
@@ -366,15 +419,41 @@ class ContestDetailProblemSubmitHandler(base.Handler, ContestStatusMixin):
 
 @app.route('/contest/{tid:\d{4,}}/status', 'contest_status')
 class ContestStatusHandler(base.Handler, ContestStatusMixin):
+    STATUS_SNAPSHOT_EXPIRE_SECONDS = 86400
+
     @base.require_perm(builtin.PERM_VIEW_CONTEST)
     @base.require_perm(builtin.PERM_VIEW_CONTEST_STATUS)
     @base.route_argument
     @base.sanitize
     async def get(self, *, tid: int):
-        tdoc, tsdocs = await contest.get_and_list_status(self.domain_id, tid)
+        board = await scoreboard.get(self.domain_id, tid)
+        tdoc = board.tdoc
         if (not contest.RULES[tdoc['rule']].show_func(tdoc, self.now)
                 and not self.has_perm(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS)):
             raise error.ContestStatusHiddenError()
+        rev = await contest.get_status_rev(tid)
+        if self.check_not_modified((tdoc, rev)):
+            return
+        status_html = await self._get_status_html(board, rev)
+        path_components = self.build_path(
+            (self.translate('contest_main'), self.reverse_url('contest_main')),
+            (tdoc['title'], self.reverse_url('contest_detail', tid=tdoc['_id'])),
+            (self.translate('contest_status'), None)
+        )
+        self.render('contest_status.html', tdoc=tdoc, rev=rev, status_html=status_html,
+                    path_components=path_components)
+
+    async def _get_status_html(self, board, rev):
+        """Get the rendered scoreboard at a revision, rendered once for all workers in a language."""
+        tdoc = board.tdoc
+        key = 'contest-status-{0}-{1}-{2}'.format(tdoc['_id'], self.domain_id, self.view_lang)
+        db = await redis.database()
+        value = await db.get(key)
+        if value:
+            snapshot = json.decode(value.decode())
+            if snapshot['rev'] == rev:
+                return snapshot['html']
+        tsdocs = board.get_tsdocs()
         udict, pdict = await asyncio.gather(
             user.get_dict([tsdoc['uid'] for tsdoc in tsdocs]),
             problem.get_dict(self.domain_id, tdoc['pids'])
@@ -382,13 +461,15 @@ class ContestStatusHandler(base.Handler, ContestStatusMixin):
         for index, pid in enumerate(tdoc['pids']):
             pdict[pid]['letter'] = chr(ord('A') + index)
         ranked_tsdocs = contest.RULES[tdoc['rule']].rank_func(tsdocs)
-        path_components = self.build_path(
-            (self.translate('contest_main'), self.reverse_url('contest_main')),
-            (tdoc['title'], self.reverse_url('contest_detail', tid=tdoc['_id'])),
-            (self.translate('contest_status'), None)
-        )
-        self.render('contest_status.html', tdoc=tdoc, ranked_tsdocs=ranked_tsdocs, dict=dict,
-                    udict=udict, pdict=pdict, path_components=path_components)
+        html = self.render_html('partials/contest_status_{0}.html'.format(
+                                    constant.contest.RULE_ID[tdoc['rule']]),
+                                tdoc=tdoc, ranked_tsdocs=ranked_tsdocs, dict=dict,
+                                udict=udict, pdict=pdict)
+        # A scoreboard behind the revision is rendered for this request only.
+        if board.rev >= rev:
+            await db.set(key, json.encode({'rev': rev, 'html': html}),
+                         expire=self.STATUS_SNAPSHOT_EXPIRE_SECONDS)
+        return html
 
 
 @app.route('/contest/{tid:\d{4,}}/edit', 'contest_edit')
@@ -1,5 +1,6 @@
 import asyncio
 import calendar
+import collections
 import logging
 from bson import objectid
 
@@ -16,10 +17,30 @@ from anubis.model import contest
 from anubis.model import problem
 from anubis.model.adaptor import judge
 from anubis.service import bus
+from anubis.service import metrics
 from anubis.handler import base
+from anubis.util import options
+
+options.define('judge_max_capacity', default=64,
+               help='Maximum number of records a judge connection can judge at the same time.')
 
 _logger = logging.getLogger(__name__)
 
+# Interval of reporting the status of a judge connection, in seconds.
+JUDGE_STATUS_INTERVAL_SECONDS = 30
+
+
+async def _get_queue_depths():
+    depths = await asyncio.gather(*[queue.get_depth(key) for key in record.QUEUE_WEIGHTS])
+    return collections.OrderedDict(zip(record.QUEUE_WEIGHTS, depths))
+
+
+async def _collect_queue_depths():
+    return dict(((('queue', key),), depth) for key, depth in (await _get_queue_depths()).items())
+
+
+metrics.add_gauge('anubis_queue_depth', 'Number of messages ready in a judge queue.', _collect_queue_depths)
+
 
 @app.route('/judge/playground', 'judge_playground')
 class JudgePlaygroundHandler(base.Handler):
@@ -59,12 +80,36 @@ class JudgeHeartbeatHandler(base.Handler):
 
 @app.connection_route('/judge/consume-conn', 'judge_consume-conn')
 class JudgeNotifyConnection(base.Connection):
+    # Not set if on_open failed before starting them.
+    consumer = None
+    report_task = None
+
     @base.require_priv(builtin.PRIV_READ_RECORD_CODE | builtin.PRIV_WRITE_RECORD)
     async def on_open(self):
         self.rids = {}  # delivery_tag -> rid
+        try:
+            capacity = int(self.request.GET.get('capacity', 1))
+        except ValueError:
+            capacity = 1
+        self.capacity = min(max(capacity, 1), options.options.judge_max_capacity)
         bus.subscribe(self.on_problem_data_change, ['problem_data_change'])
-        self.channel = await queue.consume('judge', self._on_queue_message)
-        asyncio.ensure_future(self.channel.close_event.wait()).add_done_callback(lambda _: self.close())
+        self.consumer = await queue.consume_weighted(record.QUEUE_WEIGHTS, self._on_queue_message,
+                                                     self.capacity)
+        asyncio.ensure_future(self.consumer.channel.close_event.wait()) \
+            .add_done_callback(lambda _: self.close())
+        self.report_task = asyncio.ensure_future(self._report_status_forever())
+
+    async def _report_status(self):
+        try:
+            await queue.set_consumer('judge', self.id, uid=self.user['_id'], uname=self.user['uname'],
+                                     capacity=self.capacity, rids=list(self.rids.values()))
+        except Exception as e:
+            _logger.warning('Failed to report judge status: %s', repr(e))
+
+    async def _report_status_forever(self):
+        while True:
+            await self._report_status()
+            await asyncio.sleep(JUDGE_STATUS_INTERVAL_SECONDS)
 
     async def on_problem_data_change(self, e):
         domain_id_pid = dict(e['value'])
@@ -76,11 +121,11 @@ class JudgeNotifyConnection(base.Connection):
         if rdoc:
             self.rids[tag] = rdoc['_id']
             self.send(rid=str(rdoc['_id']), tag=tag, pid=str(rdoc['pid']), domain_id=rdoc['domain_id'],
-                      lang=rdoc['lang'], code=rdoc['code'], type=rdoc['type'])
-            await bus.publish('record_change', rdoc['_id'])
+                      lang=rdoc['lang'], code=await record.get_code(rdoc), type=rdoc['type'])
+            await asyncio.gather(bus.publish('record_change', rdoc['_id']), self._report_status())
         else:
             # Record not found, eat it.
-            await self.channel.basic_client_ack(tag)
+            await self.consumer.ack(tag)
 
     async def on_message(self, *, key, tag, **kwargs):
         if key == 'next':
@@ -101,32 +146,54 @@ class JudgeNotifyConnection(base.Connection):
                 }
             if 'progress' in kwargs:
                 update.setdefault('$set', {})['progress'] = float(kwargs['progress'])
-            await record.next_judge(rid, self.user['_id'], **update)
-            await bus.publish('record_change', rid)
+            await judge.next_judge(rid, self.user['_id'], **update)
         elif key == 'end':
             rid = self.rids.pop(tag)
+            await judge.flush_next_judge(rid)
             rdoc, _ = await asyncio.gather(record.end_judge(rid, self.user['_id'],
                                                             int(kwargs['status']),
                                                             int(kwargs['time_ms']),
                                                             int(kwargs['memory_kb'])),
-                                           self.channel.basic_client_ack(tag))
-            await judge.post_judge(rdoc)
+                                           self.consumer.ack(tag))
+            await asyncio.gather(judge.post_judge(rdoc), self._report_status())
         elif key == 'nack':
-            await self.channel.basic_client_nack(tag)
+            self.rids.pop(tag, None)
+            await asyncio.gather(self.consumer.nack(tag), self._report_status())
 
     async def on_close(self):
         async def close():
             async def reset_record(rid):
-                await record.end_judge(rid, self.user['_id'], self.id,
-                                       constant.record.STATUS_WAITING, 0, 0, 0)
+                await judge.flush_next_judge(rid)
+                await record.end_judge(rid, self.user['_id'], constant.record.STATUS_WAITING, 0, 0)
                 await bus.publish('record_change', rid)
 
-            await asyncio.gather(*[reset_record(rid) for rid in self.rids.values()])
-            await self.channel.close()
+            if self.report_task:
+                self.report_task.cancel()
+            await asyncio.gather(*[reset_record(rid) for rid in getattr(self, 'rids', {}).values()],
+                                 queue.delete_consumer('judge', self.id))
+            if self.consumer:
+                await self.consumer.close()
 
         asyncio.get_event_loop().create_task(close())
 
 
+@app.route('/judge/status', 'judge_status')
+class JudgeStatusHandler(base.Handler):
+    @base.require_priv(builtin.PRIV_VIEW_METRICS)
+    async def get(self):
+        depths, consumers = await asyncio.gather(_get_queue_depths(), queue.get_consumers('judge'))
+        judges = []
+        for judge_id, status in sorted(consumers.items()):
+            judges.append({'id': judge_id, 'uid': status['uid'], 'uname': status['uname'],
+                           'capacity': status['capacity'], 'in_flight': len(status['rids']),
+                           'utilization': len(status['rids']) / status['capacity'], 'rids': status['rids']})
+        capacity = sum(j['capacity'] for j in judges)
+        in_flight = sum(j['in_flight'] for j in judges)
+        self.json({'depth': sum(depths.values()), 'depths': depths,
+                   'capacity': capacity, 'in_flight': in_flight,
+                   'utilization': in_flight / capacity if capacity else 0.0, 'judges': judges})
+
+
 @app.route('/judge/main', 'judge_main')
 class JudgeMainHandler(base.OperationHandler):
     @base.require_priv(builtin.JUDGE_PRIV)
@@ -134,6 +201,7 @@ class JudgeMainHandler(base.OperationHandler):
     async def post_begin(self, *, rid: objectid.ObjectId, status: int):
         rdoc = await record.begin_judge(rid, self.user['_id'], status)
         if rdoc:
+            rdoc['code'] = await record.get_code(rdoc)
             await bus.publish('record_change', str(rid))
         await user.update(self.user['_id'], status={'code': constant.record.STATUS_FETCHED,
                                                     'rid': rid})
@@ -158,7 +226,7 @@ class JudgeMainHandler(base.OperationHandler):
             }
         if 'progress' in kwargs:
             update.setdefault('$set', {})['progress'] = float(kwargs['progress'])
-        rdoc = await record.next_judge(record_id=rid, judge_uid=self.user['_id'], **update)
+        rdoc = await record.next_judge(rid, self.user['_id'], **update)
         await bus.publish('record_change', str(rid))
         if 'status' in kwargs:
             await user.update(self.user['_id'], status={'code': kwargs['status'],
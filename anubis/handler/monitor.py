@@ -0,0 +1,22 @@
+import hmac
+
+from anubis import app
+from anubis.handler import base
+from anubis.model import builtin
+from anubis.service import metrics
+from anubis.util import options
+
+options.define('metrics_token', default='',
+               help='Bearer token allowing scrapers to read metrics without a privileged session.')
+
+
+@app.route('/metrics', 'metrics')
+class MetricsHandler(base.Handler):
+    async def get(self):
+        authorization = self.request.headers.get('Authorization', '')
+        if not (options.options.metrics_token
+                and hmac.compare_digest(authorization, 'Bearer ' + options.options.metrics_token)):
+            self.check_priv(builtin.PRIV_VIEW_METRICS)
+        self.response.content_type = 'text/plain'
+        self.response.headers['Cache-Control'] = 'no-store'
+        self.response.text = await metrics.render()
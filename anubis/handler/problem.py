@@ -9,7 +9,6 @@ from anubis import error
 from anubis import constant
 from anubis.handler import base
 from anubis.model import builtin
-from anubis.model import user
 from anubis.model import problem
 from anubis.model import domain
 from anubis.model import fs
@@ -140,10 +139,10 @@ class ProblemDetailHandler(base.Handler):
     @base.sanitize
     async def get(self, *, pid: int):
         uid = self.user['_id'] if self.has_priv(builtin.PRIV_USER_PROFILE) else None
-        pdoc = await problem.get(self.domain_id, pid, uid)
+        pdoc = await self.loader.get_problem(self.domain_id, pid, uid)
         if pdoc.get('hidden', False):
             self.check_perm(builtin.PERM_VIEW_PROBLEM_HIDDEN)
-        udoc = await user.get_by_uid(pdoc['owner_uid'])
+        udoc = await self.loader.get_user(pdoc['owner_uid'])
         # TODO: tdoc
         path_components = self.build_path(
             (self.translate('problem_main'), self.reverse_url('problem_main')),
@@ -161,10 +160,10 @@ class ProblemSubmitHandler(base.Handler):
     async def get(self, *, pid: int):
         # TODO: check status, eg. test, hidden problem, ...
         uid = self.user['_id'] if self.has_priv(builtin.PRIV_USER_PROFILE) else None
-        pdoc = await problem.get(self.domain_id, pid, uid)
+        pdoc = await self.loader.get_problem(self.domain_id, pid, uid)
         if pdoc.get('hidden', False):
             self.check_perm(builtin.PERM_VIEW_PROBLEM_HIDDEN)
-        udoc = await user.get_by_uid(pdoc['owner_uid'])
+        udoc = await self.loader.get_user(pdoc['owner_uid'])
         if uid is None:
             rdocs = []
         else:
@@ -327,8 +326,8 @@ class ProblemEditHandler(base.Handler):
     @base.sanitize
     async def get(self, *, pid: int):
         uid = self.user['_id'] if self.has_priv(builtin.PRIV_USER_PROFILE) else None
-        pdoc = await problem.get(self.domain_id, pid, uid)
-        udoc = await user.get_by_uid(pdoc['owner_uid'])
+        pdoc = await self.loader.get_problem(self.domain_id, pid, uid)
+        udoc = await self.loader.get_user(pdoc['owner_uid'])
         path_coponents = self.build_path(
             (self.translate('problem_main'), self.reverse_url('problem_main')),
             (pdoc['title'], self.reverse_url('problem_detail', pid=pdoc['_id'])),
@@ -364,8 +363,8 @@ class ProblemSettingsHandler(base.Handler):
     @base.sanitize
     async def get(self, *, pid: int):
         uid = self.user['_id'] if self.has_priv(builtin.PRIV_USER_PROFILE) else None
-        pdoc = await problem.get(self.domain_id, pid, uid)
-        udoc = await user.get_by_uid(pdoc['owner_uid'])
+        pdoc = await self.loader.get_problem(self.domain_id, pid, uid)
+        udoc = await self.loader.get_user(pdoc['owner_uid'])
         path_components = self.build_path(
             (self.translate('problem_main'), self.reverse_url('problem_main')),
             (pdoc['title'], self.reverse_url('problem_detail', pid=pdoc['_id'])),
@@ -428,10 +427,10 @@ class ProblemStatisticsHandler(base.Handler):
     @base.sanitize
     async def get(self, *, pid: int):
         uid = self.user['_id'] if self.has_priv(builtin.PRIV_USER_PROFILE) else None
-        pdoc = await problem.get(self.domain_id, pid, uid)
+        pdoc = await self.loader.get_problem(self.domain_id, pid, uid)
         if pdoc.get('hidden', False):
             self.check_perm(builtin.PERM_VIEW_PROBLEM_HIDDEN)
-        udoc = await user.get_by_uid(pdoc['owner_uid'])
+        udoc = await self.loader.get_user(pdoc['owner_uid'])
         path_components = self.build_path(
             (self.translate('problem_main'), self.reverse_url('problem_main')),
             (pdoc['title'], self.reverse_url('problem_detail', pid=pdoc['_id'])),
@@ -1,9 +1,6 @@
 import asyncio
 import datetime
-import struct
-import calendar
-import io
-import zipfile
+from urllib import parse
 from bson import objectid
 
 from anubis import app
@@ -11,7 +8,7 @@ from anubis import constant
 from anubis import error
 from anubis.handler import base
 from anubis.model import builtin
-from anubis.model import domain
+from anubis.model import judgestat
 from anubis.model import record
 from anubis.model import user
 from anubis.model import problem
@@ -20,35 +17,45 @@ from anubis.model import testdata
 from anubis.service import bus
 
 
+async def _get_query(domain_id, uid_or_name, pid, tid):
+    query = {}
+    if uid_or_name:
+        try:
+            query['uid'] = int(uid_or_name)
+        except ValueError:
+            udoc = await user.get_by_uname(uid_or_name)
+            if not udoc:
+                raise error.UserNotFoundError(uid_or_name) from None
+            query['uid'] = udoc['_id']
+    if pid:
+        query['domain_id'] = domain_id
+        query['pid'] = int(pid)
+    if tid:
+        query['domain_id'] = domain_id
+        query['tid'] = int(tid)
+    return query
+
+
 @app.route('/records', 'record_main')
 class RecordMainHandler(base.Handler):
+    RECORDS_PER_PAGE = 50
+
     @base.get_argument
     @base.sanitize
-    async def get(self, *, uid_or_name: str='', pid: str='', tid: str=''):
-        query = {}
-        if uid_or_name:
-            try:
-                query['uid'] = int(uid_or_name)
-            except ValueError:
-                udoc = await user.get_by_uname(uid_or_name)
-                if not udoc:
-                    raise error.UserNotFoundError(uid_or_name) from None
-                query['uid'] = udoc['_id']
-        if pid:
-            query['domain_id'] = self.domain_id
-            query['pid'] = int(pid)
-        if tid:
-            query['domain_id'] = self.domain_id
-            query['tid'] = int(tid)
-        # TODO: projection, pagination
-        rdocs = await record.get_all_multi(**query,
-                                           get_hidden=self.has_priv(builtin.PRIV_VIEW_HIDDEN_RECORD)
-                                           ).sort([('_id', -1)]).limit(50).to_list(None)
+    async def get(self, *, uid_or_name: str='', pid: str='', tid: str='', before: objectid.ObjectId=None):
+        query = await _get_query(self.domain_id, uid_or_name, pid, tid)
+        rdocs = record.get_all_multi(end_id=before,
+                                     get_hidden=self.has_priv(builtin.PRIV_VIEW_HIDDEN_RECORD),
+                                     projection=record.PROJECTION_LIST,
+                                     **query).sort([('_id', -1)])
+        # Fetch one more record to know whether there is a next page.
+        rdocs = await rdocs.limit(self.RECORDS_PER_PAGE + 1).to_list(None)
+        has_next = len(rdocs) > self.RECORDS_PER_PAGE
+        rdocs = rdocs[:self.RECORDS_PER_PAGE]
         if rdocs:
-            # TODO: projection
             udict, pdict = await asyncio.gather(
-                user.get_dict(rdoc['uid'] for rdoc in rdocs),
-                problem.get_dict_multi_domain((rdoc['domain_id'], rdoc['pid']) for rdoc in rdocs)
+                self.loader.get_user_dict(rdoc['uid'] for rdoc in rdocs),
+                self.loader.get_problem_dict_multi_domain((rdoc['domain_id'], rdoc['pid']) for rdoc in rdocs)
             )
         else:
             udict = {}
@@ -56,21 +63,72 @@ class RecordMainHandler(base.Handler):
         # statistics
         statistics = None
         if self.has_priv(builtin.PRIV_VIEW_JUDGE_STATISTICS):
-            ts = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
+            now = datetime.datetime.utcnow()
             day_count, week_count, month_count, year_count, rcount = await asyncio.gather(
-                record.get_count(objectid.ObjectId(
-                    struct.pack('>i', ts - 24 * 3600) + struct.pack('b', -1) * 8)),
-                record.get_count(objectid.ObjectId(
-                    struct.pack('>i', ts - 7 * 24 * 3600) + struct.pack('b', -1) * 8)),
-                record.get_count(objectid.ObjectId(
-                    struct.pack('>i', ts - 30 * 24 * 3600) + struct.pack('b', -1) * 8)),
-                record.get_count(objectid.ObjectId(
-                    struct.pack('>i', ts - int(365.2425 * 24 * 3600)) + struct.pack('b', -1) * 8)),
-                record.get_count())
+                judgestat.get_count(now - datetime.timedelta(days=1)),
+                judgestat.get_count(now - datetime.timedelta(days=7)),
+                judgestat.get_count(now - datetime.timedelta(days=30)),
+                judgestat.get_count(now - datetime.timedelta(days=365.2425)),
+                judgestat.get_count())
             statistics = {'day': day_count, 'week': week_count, 'month': month_count,
                           'year': year_count, 'total': rcount}
+        qs = parse.urlencode([(k, v) for k, v in [('uid_or_name', uid_or_name), ('pid', pid), ('tid', tid)]
+                              if v])
         self.render('record_main.html', rdocs=rdocs, udict=udict, pdict=pdict, statistics=statistics,
-                    filter_uid_or_name=uid_or_name, filter_pid=pid, filter_tid=tid)
+                    filter_uid_or_name=uid_or_name, filter_pid=pid, filter_tid=tid,
+                    before=before, next_before=rdocs[-1]['_id'] if has_next else None, qs=qs)
+
+
+class RecordChangeHub(object):
+    """Fan-out of record changes to the record list connections of this worker.
+
+    A changed record is fetched once, and rendered once for each group of connections which see
+    the same row.
+    """
+
+    def __init__(self):
+        self.conns = set()
+
+    def add(self, conn):
+        if not self.conns:
+            bus.subscribe(self.on_record_change, ['record_change'])
+        self.conns.add(conn)
+
+    def remove(self, conn):
+        self.conns.discard(conn)
+        if not self.conns:
+            bus.unsubscribe(self.on_record_change)
+
+    async def on_record_change(self, e):
+        rdoc = await record.get(objectid.ObjectId(e['value']), record.PROJECTION_PUBLIC)
+        if not rdoc:
+            return
+        conns = [conn for conn in self.conns if conn.match(rdoc)]
+        if not conns:
+            return
+        if rdoc['tid']:
+            tdoc, udoc, pdoc = await asyncio.gather(contest.get(rdoc['domain_id'], rdoc['tid']),
+                                                    user.get_by_uid(rdoc['uid']),
+                                                    problem.get(rdoc['domain_id'], rdoc['pid']))
+            show_status = contest.RULES[tdoc['rule']].show_func(tdoc, datetime.datetime.utcnow())
+            show_progress = not (rdoc['status'] == constant.record.STATUS_JUDGING and len(rdoc['cases']))
+        else:
+            tdoc = None
+            udoc, pdoc = await asyncio.gather(user.get_by_uid(rdoc['uid']),
+                                              problem.get(rdoc['domain_id'], rdoc['pid']))
+            show_status, show_progress = True, True
+        htmls = {}
+        for conn in conns:
+            if conn not in self.conns or not conn.can_view(tdoc, show_status, show_progress):
+                continue
+            key = conn.get_render_key(pdoc)
+            if key not in htmls:
+                htmls[key] = conn.render_html('record_main_tr.html', rdoc=rdoc, udoc=udoc,
+                                              pdoc=pdoc if key[-1] else None)
+            conn.send(html=htmls[key])
+
+
+_record_change_hub = RecordChangeHub()
 
 
 @app.connection_route('/records-conn', 'record_main-conn')
@@ -78,30 +136,41 @@ class RecordMainConnection(base.Connection):
     @base.require_priv(builtin.PRIV_USER_PROFILE)
     async def on_open(self):
         await super(RecordMainConnection, self).on_open()
-        bus.subscribe(self.on_record_change, ['record_change'])
+        get = self.request.GET.get
+        self.query = await _get_query(self.domain_id, get('uid_or_name', ''), get('pid', ''), get('tid', ''))
+        self.before = objectid.ObjectId(get('before')) if get('before') else None
+        self.get_hidden = self.has_priv(builtin.PRIV_VIEW_HIDDEN_RECORD)
+        _record_change_hub.add(self)
 
-    async def on_record_change(self, e):
-        rdoc = await record.get(objectid.ObjectId(e['value']), record.PROJECTION_PUBLIC)
-        # check permission for visibility: contest
-        if rdoc['tid']:
-            now = datetime.datetime.utcnow()
-            tdoc = await contest.get(rdoc['domain_id'], rdoc['tid'])
-            if (not contest.RULES[tdoc['rule']].show_func(tdoc, now)
-                and (self.domain_id != tdoc['domain_id']
-                     or not self.has_perm(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS))
-                or (rdoc['status'] == constant.record.STATUS_JUDGING and len(rdoc['cases'])
-                    and not (self.has_perm(builtin.PERM_READ_RECORD_DETAIL)
-                             or self.has_priv(builtin.PRIV_READ_RECORD_DETAIL)))):
-                return
-        udoc, pdoc = await asyncio.gather(user.get_by_uid(rdoc['uid']),
-                                          problem.get(rdoc['domain_id'], rdoc['pid']))
-        if pdoc.get('hidden', False) and (pdoc['domain_id'] != self.domain_id
-                                          or not self.has_perm(builtin.PERM_VIEW_PROBLEM_HIDDEN)):
-            pdoc = None
-        self.send(html=self.render_html('record_main_tr.html', rdoc=rdoc, udoc=udoc, pdoc=pdoc))
+    def match(self, rdoc):
+        """Check whether the record is in the list of this connection."""
+        if rdoc['hidden'] and not self.get_hidden:
+            return False
+        if self.before and rdoc['_id'] >= self.before:
+            return False
+        return all(rdoc[key] == value for key, value in self.query.items())
+
+    def can_view(self, tdoc, show_status, show_progress):
+        if not show_status and (self.domain_id != tdoc['domain_id']
+                                or not self.has_perm(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS)):
+            return False
+        if not show_progress and not (self.has_perm(builtin.PERM_READ_RECORD_DETAIL)
+                                      or self.has_priv(builtin.PRIV_READ_RECORD_DETAIL)):
+            return False
+        return True
+
+    def get_render_key(self, pdoc):
+        """Get the key of connections which render the same row of the record list."""
+        can_rejudge = ((pdoc['domain_id'] == self.domain_id and self.has_perm(builtin.PERM_REJUDGE))
+                       or self.has_priv(builtin.PRIV_REJUDGE))
+        show_pdoc = not pdoc.get('hidden', False) or (pdoc['domain_id'] == self.domain_id
+                                                      and self.has_perm(builtin.PERM_VIEW_PROBLEM_HIDDEN))
+        # The rejudge form carries the CSRF token of the session, so such rows are not shared.
+        return (self.domain_id, self.view_lang, self.timezone.zone,
+                self.csrf_token if can_rejudge else None, show_pdoc)
 
     async def on_close(self):
-        bus.unsubscribe(self.on_record_change)
+        _record_change_hub.remove(self)
 
 
 @app.route('/records/{rid}', 'record_detail')
@@ -133,19 +202,20 @@ class RecordDetailHandler(base.Handler):
         else:
             tdoc = None
         # TODO: Check permission for visibility: contest
-        if (not self.own(rdoc, field='uid')
-            and not self.has_perm(builtin.PERM_READ_RECORD_CODE)
-            and not self.has_priv(builtin.PRIV_READ_RECORD_CODE)):
-            del rdoc['code']
+        if (self.own(rdoc, field='uid')
+            or self.has_perm(builtin.PERM_READ_RECORD_CODE)
+            or self.has_priv(builtin.PRIV_READ_RECORD_CODE)):
+            rdoc['code'] = await record.get_code(rdoc)
+        else:
+            rdoc.pop('code', None)
+        rdoc.pop('code_id', None)
         if not show_status and 'code' not in rdoc:
             raise error.PermissionError(builtin.PERM_VIEW_CONTEST_HIDDEN_STATUS)
-        udoc, dudoc, pdoc = await asyncio.gather(user.get_by_uid(rdoc['uid']),
-                                                 domain.get_user(self.domain_id, rdoc['uid']),
-                                                 problem.get(rdoc['domain_id'], rdoc['pid']))
-        if show_status and 'judge_uid' in rdoc:
-            judge_udoc = await user.get_by_uid(rdoc['judge_uid'])
-        else:
-            judge_udoc = None
+        udoc, dudoc, pdoc, judge_udoc = await asyncio.gather(
+            self.loader.get_user(rdoc['uid']),
+            self.loader.get_domain_user(self.domain_id, rdoc['uid']),
+            self.loader.get_problem(rdoc['domain_id'], rdoc['pid']),
+            self.loader.get_user(rdoc.get('judge_uid') if show_status else None))
         if pdoc.get('hidden', False) and not self.has_perm(builtin.PERM_VIEW_PROBLEM_HIDDEN):
             pdoc = None
         self.render('record_detail.html', rdoc=rdoc, udoc=udoc, dudoc=dudoc, pdoc=pdoc,
@@ -182,18 +252,13 @@ class RecordPretestDataHandler(base.Handler):
         if not ddoc:
             raise error.RecordDataNotFoundError(rdoc['_id'])
 
-        output_buffer = io.BytesIO()
-        zip_file = zipfile.ZipFile(output_buffer, 'a', zipfile.ZIP_DEFLATED)
+        zip_writer = await self.zip_stream()
         config_content = str(len(ddoc['content'])) + '\n'
         for i, (data_input, data_output) in enumerate(ddoc['content']):
             input_file = 'input{0}.txt'.format(i)
             output_file = 'output{0}.txt'.format(i)
             config_content += '{0}|{1}|1|10|262144\n'.format(input_file, output_file)
-            zip_file.writestr('Input/{0}'.format(input_file), data_input)
-            zip_file.writestr('Output/{0}'.format(output_file), data_output)
-        zip_file.writestr('Config.ini', config_content)
-        for zfile in zip_file.filelist:
-            zfile.create_system = 0
-        zip_file.close()
-
-        await self.binary(output_buffer.getvalue(), 'application/zip')
+            await zip_writer.write('Input/{0}'.format(input_file), data_input)
+            await zip_writer.write('Output/{0}'.format(output_file), data_output)
+        await zip_writer.write('Config.ini', config_content)
+        await zip_writer.close()
@@ -196,7 +196,7 @@ class UserDetailHandler(base.Handler, UserSettingsMixin):
             email = email.replace('@', random.choice([' [at] ', '#']))
         bg = random.randint(1, 21)
         rdocs = record.get_multi(get_hidden=self.has_priv(builtin.PRIV_VIEW_HIDDEN_RECORD),
-                                 uid=uid).sort([('_id', -1)])
+                                 uid=uid, projection=record.PROJECTION_LIST).sort([('_id', -1)])
         rdocs = await rdocs.limit(10).to_list(None)
         # TODO(twd2): check status, eg. test, hidden problem, ...
         pdocs = problem.get_multi(domain_id=self.domain_id, owner_uid=uid).sort([('_id', -1)])
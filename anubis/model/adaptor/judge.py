@@ -1,27 +1,135 @@
 import asyncio
+import functools
+import hashlib
+import logging
 from bson import objectid
 
 from anubis import constant
+from anubis import error
 from anubis import job
 from anubis.model import builtin
 from anubis.model import problem
 from anubis.model import record
-from anubis.model import contest
+from anubis.model import scoreboard
 from anubis.model import domain
+from anubis.model import judgestat
+from anubis.model import testdata
 from anubis.service import bus
+from anubis.service import smallcache
+from anubis.util import options
+
+options.define('judge_progress_flush_ms', default=200,
+               help='Time to coalesce progress updates of a record before writing, in milliseconds.')
+options.define('judge_progress_max_updates', default=20,
+               help='Maximum number of progress updates of a record coalesced in one write.')
+
+_logger = logging.getLogger(__name__)
+
+
+class _Progress(object):
+    def __init__(self, judge_uid):
+        self.judge_uid = judge_uid
+        self.update = {}
+        self.num_updates = 0
+        self.handle = None
+
+
+# record_id -> _Progress not written yet.
+_progresses = {}
+# record_id -> future of the last write, to keep the writes of a record in order.
+_writes = {}
+
+
+def _merge(update, new_update):
+    for op, fields in new_update.items():
+        target = update.setdefault(op, {})
+        for field, value in fields.items():
+            if op == '$push':
+                target.setdefault(field, {'$each': []})['$each'].append(value)
+            else:
+                target[field] = value
+
+
+async def next_judge(record_id: objectid.ObjectId, judge_uid: int, **update):
+    """Apply a progress update to a record, coalesced with the following ones of the record.
+
+    Updates are written together when judge_progress_flush_ms has passed since the first one, or
+    when judge_progress_max_updates are queued. Values of $push are appended in order, and those
+    of $set are overwritten by later ones. Pending updates are kept by this worker only, so this is
+    for judges on a connection, whose updates and end all come to the same worker.
+
+    Returns:
+        The record document if the updates are written by this call, otherwise None.
+    """
+    progress = _progresses.get(record_id)
+    if not progress:
+        progress = _progresses[record_id] = _Progress(judge_uid)
+        progress.handle = asyncio.get_event_loop().call_later(
+            options.options.judge_progress_flush_ms / 1000,
+            lambda: asyncio.ensure_future(_flush_later(record_id)))
+    _merge(progress.update, update)
+    progress.num_updates += 1
+    if progress.num_updates >= options.options.judge_progress_max_updates:
+        return await flush_next_judge(record_id)
+
+
+async def _flush_later(record_id):
+    try:
+        await flush_next_judge(record_id)
+    except Exception as e:
+        _logger.exception(e)
+
+
+async def flush_next_judge(record_id: objectid.ObjectId):
+    """Write the pending progress updates of a record and publish a single record change.
+
+    Must be called before end_judge of the record.
+    """
+    progress = _progresses.pop(record_id, None)
+    previous = _writes.get(record_id)
+    if not progress:
+        if previous:
+            await asyncio.wait([previous])
+        return None
+    progress.handle.cancel()
+
+    async def write():
+        if previous:
+            await asyncio.wait([previous])
+        rdoc = await record.next_judge(record_id, progress.judge_uid, **progress.update)
+        await bus.publish('record_change', record_id)
+        return rdoc
+
+    future = _writes[record_id] = asyncio.ensure_future(write())
+    future.add_done_callback(functools.partial(_on_write_done, record_id))
+    return await asyncio.shield(future)
+
+
+def _on_write_done(record_id, future):
+    if _writes.get(record_id) is future:
+        del _writes[record_id]
+
+
+def _get_score(rdoc):
+    """Get the score of a judged record out of 100, by its accepted cases."""
+    if not rdoc.get('cases'):
+        return 100 if rdoc['status'] == constant.record.STATUS_ACCEPTED else 0
+    accepted = sum(1 for case in rdoc['cases'] if case['status'] == constant.record.STATUS_ACCEPTED)
+    return accepted * 100 // len(rdoc['cases'])
 
 
 async def post_judge(rdoc):
     accept = rdoc['status'] == constant.record.STATUS_ACCEPTED
-    post_coros = [bus.publish('record_change', rdoc['_id'])]
+    post_coros = [bus.publish('record_change', rdoc['_id']),
+                  judgestat.inc(rdoc['domain_id'], rdoc['status'], at=rdoc.get('judge_at'))]
     # TODO: ignore no effect statuses like system error...
     if rdoc['type'] == constant.record.TYPE_SUBMISSION:
         if accept:
             # TODO: send ac mail
             pass
         if rdoc['tid']:
-            post_coros.append(contest.update_status(rdoc['domain_id'], rdoc['tid'], rdoc['uid'],
-                                                    rdoc['_id'], rdoc['pid'], accept))
+            post_coros.append(scoreboard.update_status(rdoc['domain_id'], rdoc['tid'], rdoc['uid'],
+                                                       rdoc['_id'], rdoc['pid'], accept, _get_score(rdoc)))
         if not rdoc.get('rejudged'):
             if await problem.update_status(rdoc['domain_id'], rdoc['pid'], rdoc['uid'],
                                            rdoc['_id'], rdoc['status']):
@@ -33,9 +141,35 @@ async def post_judge(rdoc):
     await asyncio.gather(*post_coros)
 
 
+def _normalize_answer(judge_mode, answer):
+    if judge_mode == constant.record.MODE_SUBMIT_ANSWER:
+        # Ignore blanks at the end of lines and blank lines at the end.
+        return '\n'.join(line.rstrip() for line in answer.rstrip().splitlines())
+    return answer
+
+
+def _get_answer_digest(judge_mode, answer):
+    return hashlib.sha256(_normalize_answer(judge_mode, answer).encode()).digest()
+
+
+async def _get_reference_digest(domain_id, pdoc):
+    if not pdoc.get('data', None):
+        raise error.ProblemDataNotFoundError(domain_id, pdoc['_id'])
+    key = testdata.get_answer_cache_key(domain_id, pdoc['data'])
+    value = smallcache.get_direct(key)
+    if value and value[0] == pdoc['judge_mode']:
+        return value[1]
+    ddoc = await testdata.get(domain_id, pdoc['data'])
+    if not ddoc:
+        raise error.ProblemDataNotFoundError(domain_id, pdoc['_id'])
+    digest = _get_answer_digest(pdoc['judge_mode'], ddoc['data'])
+    smallcache.set_local_direct(key, (pdoc['judge_mode'], digest))
+    return digest
+
+
 async def judge_answer(domain_id: str, rid: objectid.ObjectId, pdoc, answer: str):
-    data = await problem.get_data(domain_id, pdoc['_id'])
-    if data['data'] == answer:
+    reference_digest = await _get_reference_digest(domain_id, pdoc)
+    if _get_answer_digest(pdoc['judge_mode'], answer) == reference_digest:
         status = constant.record.STATUS_ACCEPTED
     else:
         status = constant.record.STATUS_WRONG_ANSWER
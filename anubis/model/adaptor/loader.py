@@ -0,0 +1,71 @@
+import itertools
+
+from anubis import error
+from anubis.model import builtin
+from anubis.model import domain
+from anubis.model import problem
+from anubis.model import user
+from anubis.util import dataloader
+
+
+async def _batch_users(uids):
+    result = dict((udoc['_id'], udoc) for udoc in builtin.USERS if udoc['_id'] in uids)
+    result.update(await user.get_dict(uid for uid in uids if uid not in result))
+    return result
+
+
+async def _batch_problems(pdom_and_ids):
+    return await problem.get_dict_multi_domain(pdom_and_ids)
+
+
+async def _batch_domain_users(dom_and_uids):
+    result = {}
+    key_func = lambda e: e[0]
+    for domain_id, dtuples in itertools.groupby(sorted(set(dom_and_uids), key=key_func), key=key_func):
+        dudict = await domain.get_dict_user_by_uid(domain_id, [e[1] for e in dtuples])
+        for uid, dudoc in dudict.items():
+            result[(domain_id, uid)] = dudoc
+    return result
+
+
+class Loader(object):
+    """Request-scoped identity map for user, problem and domain user documents.
+
+    Lookups issued in the same event loop tick are coalesced into one $in query. Documents are
+    shared within the request, so treat them as read-only.
+    """
+
+    def __init__(self):
+        self.users = dataloader.DataLoader(_batch_users)
+        self.problems = dataloader.DataLoader(_batch_problems)
+        self.domain_users = dataloader.DataLoader(_batch_domain_users)
+
+    async def get_user(self, uid):
+        if uid is None:
+            return None
+        return await self.users.load(uid)
+
+    async def get_user_dict(self, uids):
+        return await self.users.load_many(set(uids))
+
+    async def get_problem(self, domain_id, pid, uid=None, *, tid=None):
+        """Get a copy of a problem with the status of the user as psdoc, which may be modified.
+
+        The tid of the contest the problem is got in, if any, is reported when it is not found.
+        """
+        pdoc = await self.problems.load((domain_id, pid))
+        if not pdoc:
+            if tid is not None:
+                raise error.ProblemNotFoundError(domain_id, pid, tid)
+            raise error.ProblemNotFoundError(domain_id, pid)
+        if uid is not None:
+            psdoc = await problem.get_status(domain_id, pid=pid, uid=uid)
+        else:
+            psdoc = None
+        return {**pdoc, 'psdoc': psdoc}
+
+    async def get_problem_dict_multi_domain(self, pdom_and_ids):
+        return await self.problems.load_many(set(pdom_and_ids))
+
+    async def get_domain_user(self, domain_id, uid):
+        return await self.domain_users.load((domain_id, uid))
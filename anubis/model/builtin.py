@@ -145,6 +145,7 @@ PRIV_DELETE_FILE_SELF = 1 << 19
 PRIV_CREATE_CAMPAIGN = 1 << 20
 PRIV_EDIT_CAMPAIGN = 1 << 21
 PRIV_ATTEND_CAMPAIGN = 1 << 22
+PRIV_VIEW_METRICS = 1 << 23
 PRIV_ALL = -1
 
 DEFAULT_PRIV = PRIV_USER_PROFILE | PRIV_CREATE_FILE | PRIV_DELETE_FILE_SELF | PRIV_ATTEND_CAMPAIGN
@@ -1,15 +1,16 @@
 import collections
 import datetime
-import itertools
 
-from bson import objectid
 from pymongo import errors
 from pymongo import ReturnDocument
+from pymongo import UpdateOne
 
 from anubis import error
 from anubis import db
+from anubis import redis
 from anubis.constant import contest
 from anubis.util import argmethod
+from anubis.util import scoring
 from anubis.util import validator
 from anubis.util import json
 from anubis.model import system
@@ -28,12 +29,15 @@ RULE_TEXTS = {
     RULE_ACM: 'ACM-ICPC',
 }
 
-Rule = collections.namedtuple('Rule', ['show_func', 'stat_func', 'status_sort', 'rank_func'])
+# stat_multi_func computes the stats of all teams at once, for rebuilding. rank_func ranks sorted
+# teams, optionally starting after start - 1 ranked teams, at a team not tied with the one before.
+Rule = collections.namedtuple('Rule', ['show_func', 'stat_func', 'status_sort', 'rank_func',
+                                       'stat_multi_func'])
 
 
 def _oi_stat(tdoc, journal):
     detail = list(dict((j['pid'], j) for j in journal if j['pid'] in tdoc['pids']).values())
-    return {'score': sum(d['score'] for d in detail), 'detail': detail}
+    return {'score': sum(d.get('score', 0) for d in detail), 'detail': detail}
 
 
 def _acm_stat(tdoc, journal):
@@ -56,8 +60,8 @@ def _acm_stat(tdoc, journal):
             'detail': detail}
 
 
-def _acm_rank(tsdocs):
-    now = 1
+def _acm_rank(tsdocs, start=1):
+    now = start
     gold = contest.COUNT_GOLD
     silver = gold + contest.COUNT_SILVER
     bronze = silver + contest.COUNT_BRONZE
@@ -80,9 +84,27 @@ def _acm_rank(tsdocs):
         yield (rank, tsdoc)
 
 
+def _oi_rank(tsdocs, start=1):
+    now = start
+    rank = None
+    last_score = None
+    for tsdoc in tsdocs:
+        if not tsdoc.get('ranked', True):
+            yield ('*', tsdoc)
+            continue
+        # Teams of the same score share a rank.
+        if rank is None or tsdoc.get('score', 0) != last_score:
+            rank = now
+            last_score = tsdoc.get('score', 0)
+        now += 1
+        yield (rank, tsdoc)
+
+
 RULES = {
+    RULE_OI: Rule(lambda tdoc, now: now >= tdoc['end_at'],
+                  _oi_stat, [('score', -1)], _oi_rank, scoring.oi_stats),
     RULE_ACM: Rule(lambda tdoc, now: now >= tdoc['begin_at'],
-                   _acm_stat, [('accept', -1), ('time', 1)], _acm_rank),
+                   _acm_stat, [('accept', -1), ('time', 1)], _acm_rank, scoring.acm_stats),
 }
 
 
@@ -145,6 +167,7 @@ async def edit(domain_id: str, tid: int, **kwargs):
                                           return_document=True)
     if not tdoc:
         raise error.ContestNotFoundError(domain_id, tid)
+    await publish_status_change(domain_id, tid)
     return tdoc
 
 
@@ -182,6 +205,7 @@ async def attend(domain_id: str, tid: int, uid: int):
                                        return_document=ReturnDocument.AFTER)
     except errors.DuplicateKeyError:
         raise error.ContestAlreadyAttendedError(domain_id, tid, uid) from None
+    await publish_status_change(domain_id, tid, uid)
     coll = db.Collection('contest')
     return await coll.find_one_and_update(filter={'domain_id': domain_id,
                                                   '_id': tid},
@@ -200,6 +224,7 @@ async def remove_status(domain_id: str, tid: int, uid: int):
     await coll.delete_one({'domain_id': domain_id,
                            'tid': tid,
                            'uid': uid})
+    await publish_status_change(domain_id, tid, uid)
     return tsdoc
 
 
@@ -236,55 +261,31 @@ async def get_and_list_status(domain_id: str, tid: int, projection=None):
     return tdoc, tsdocs
 
 
-@argmethod.wrap
-async def update_status(domain_id: str, tid: int, uid: int, rid: objectid.ObjectId,
-                        pid: int, accept: bool):
-    tdoc = await get(domain_id, tid)
-    if pid not in tdoc['pids']:
-        raise error.ValidationError('pid')
+async def get_status_rev(tid):
+    """Get the revision of the status of a contest, which increases on every change of its rows."""
+    db = await redis.database()
+    return int(await db.get('contest-status-rev-' + str(tid)) or 0)
 
-    coll = db.Collection('contest.status')
-    tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
-                                                   'tid': tid,
-                                                   'uid': uid},
-                                           update={
-                                               '$push': {
-                                                   'journal': {'rid': rid,
-                                                               'pid': pid,
-                                                               'accept': accept}
-                                               },
-                                               '$inc': {'rev': 1}},
-                                           return_document=ReturnDocument.AFTER)
-    if not tsdoc:
-        return {}
-    if 'attend' not in tsdoc or not tsdoc['attend']:
-        raise error.ContestNotAttendedError(domain_id, tid, uid)
-
-    # Sort and uniquify journal of the contest status, by rid.
-
-    key_func = lambda j: j['rid']
-    journal = [list(g)[-1]
-               for _, g in itertools.groupby(sorted(tsdoc['journal'], key=key_func), key=key_func)]
-    stats = RULES[tdoc['rule']].stat_func(tdoc, journal)
-    psdict = {}
-    for detail in tsdoc.get('detail', []):
-        psdict[detail['pid']] = detail
-    for detail in stats.get('detail', []):
-        detail['balloon'] = psdict.get(detail['pid'], {'balloon': False}).get('balloon', False)
-    tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
-                                                   'tid': tid,
-                                                   'uid': uid},
-                                           update={'$set': {'journal': journal, **stats},
-                                                   '$inc': {'rev': 1}},
-                                           return_document=ReturnDocument.AFTER)
-    await bus.publish('contest_notification-' + str(tid), json.encode({'type': 'rank_changed'}))
-    if accept and not psdict.get(pid, {'accept': False})['accept']:
-        await set_status_balloon(domain_id, tid, uid, pid, False)
-    return tsdoc
+
+async def publish_status_change(domain_id, tid, uid=None, rev=None):
+    """Increase the revision of the status of a contest, and notify the scoreboards in memory.
+
+    Without uid, the contest itself is changed and its scoreboards are dropped. Without rev, the row
+    of the team is read again anyway.
+
+    Returns:
+        The new revision of the status of the contest.
+    """
+    db = await redis.database()
+    contest_rev = await db.incr('contest-status-rev-' + str(tid))
+    await bus.publish('contest_status_change', json.encode({'domain_id': domain_id, 'tid': tid, 'uid': uid,
+                                                            'rev': rev, 'contest_rev': contest_rev}))
+    return contest_rev
 
 
 @argmethod.wrap
 async def set_status_balloon(domain_id: str, tid: int, uid: int, pid: int, balloon: bool=True):
+    """Set whether the balloon of a problem is sent to a team, queueing it in contest.balloon."""
     tdoc = await get(domain_id, tid)
     if pid not in tdoc['pids']:
         raise error.ValidationError('pid')
@@ -294,19 +295,52 @@ async def set_status_balloon(domain_id: str, tid: int, uid: int, pid: int, ballo
                                                    'tid': tid,
                                                    'uid': uid,
                                                    'detail.pid': pid},
-                                           update={'$set': {'detail.$.balloon': balloon}},
+                                           update={'$set': {'detail.$.balloon': balloon},
+                                                   '$inc': {'rev': 1}},
                                            return_document=ReturnDocument.AFTER)
+    if tsdoc:
+        await publish_status_change(domain_id, tid, uid, tsdoc['rev'])
     udoc = await user.get_by_uid(uid)
-    await bus.publish('balloon_change', json.encode({'uid': uid,
-                                                     'uname': udoc['uname'],
-                                                     'nickname': udoc.get('nickname', ''),
-                                                     'tid': tid,
-                                                     'pid': pid,
-                                                     'letter': convert_to_letter(tdoc['pids'], pid),
-                                                     'balloon': balloon}))
+    bdoc = await db.Collection('contest.balloon').find_one_and_update(
+        filter={'domain_id': domain_id,
+                'tid': tid,
+                'uid': uid,
+                'pid': pid},
+        update={'$set': {'uname': udoc['uname'],
+                         'nickname': udoc.get('nickname', ''),
+                         'letter': convert_to_letter(tdoc['pids'], pid),
+                         'balloon': balloon}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER)
+    await bus.publish('balloon_change-' + domain_id, json.encode(bdoc))
     return tsdoc
 
 
+def get_multi_balloon(*, projection=None, **kwargs):
+    """Get balloons of teams, ordered by _id as the first accepts of their problems come."""
+    coll = db.Collection('contest.balloon')
+    return coll.find(kwargs, projection=projection)
+
+
+@argmethod.wrap
+async def rebuild_balloon(domain_id: str, tid: int):
+    """Add the balloons of a contest accepted before contest.balloon was kept."""
+    tdoc = await get(domain_id, tid)
+    tsdocs = await get_multi_status(domain_id=domain_id, tid=tid, **{'detail.accept': True},
+                                    projection={'uid': 1, 'detail': 1}).to_list(None)
+    udict = await user.get_dict([tsdoc['uid'] for tsdoc in tsdocs])
+    updates = [UpdateOne({'domain_id': domain_id, 'tid': tid, 'uid': tsdoc['uid'], 'pid': pdetail['pid']},
+                         {'$setOnInsert': {'uname': udict[tsdoc['uid']]['uname'],
+                                           'nickname': udict[tsdoc['uid']].get('nickname', ''),
+                                           'letter': convert_to_letter(tdoc['pids'], pdetail['pid']),
+                                           'balloon': pdetail.get('balloon', False)}},
+                         upsert=True)
+               for tsdoc in tsdocs for pdetail in tsdoc['detail'] if pdetail['accept']]
+    if updates:
+        await db.Collection('contest.balloon').bulk_write(updates, ordered=False)
+    return len(updates)
+
+
 @argmethod.wrap
 async def create_indexes():
     coll = db.Collection('contest')
@@ -325,6 +359,9 @@ async def create_indexes():
                                     ('tid', 1),
                                     ('accept', -1),
                                     ('time', 1)], sparse=True)
+    await status_coll.create_index([('domain_id', 1),
+                                    ('tid', 1),
+                                    ('score', -1)], sparse=True)
     await status_coll.create_index([('domain_id', 1),
                                     ('tid', 1),
                                     ('detail.accept', 1),
@@ -333,6 +370,14 @@ async def create_indexes():
                                     ('tid', 1),
                                     ('uid', 1),
                                     ('detail.pid', 1)], sparse=True)
+    balloon_coll = db.Collection('contest.balloon')
+    await balloon_coll.create_index([('domain_id', 1),
+                                     ('tid', 1),
+                                     ('uid', 1),
+                                     ('pid', 1)], unique=True)
+    await balloon_coll.create_index([('domain_id', 1),
+                                     ('balloon', 1),
+                                     ('_id', 1)])
 
 
 if __name__ == '__main__':
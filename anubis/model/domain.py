@@ -1,8 +1,10 @@
 from pymongo import errors
+from pymongo import UpdateOne
 
 from anubis import db
 from anubis import error
 from anubis.model import builtin
+from anubis.service import smallcache
 from anubis.util import argmethod
 from anubis.util import validator
 
@@ -36,8 +38,21 @@ async def get(domain_id: str, fields=None):
     for domain in builtin.DOMAINS:
         if domain['_id'] == domain_id:
             return domain
+    if fields is None:
+        ddoc = smallcache.get(smallcache.PREFIX_DOMAIN + domain_id)
+        if ddoc:
+            return ddoc
     coll = db.Collection('domain')
-    return await coll.find_one(domain_id, fields)
+    ddoc = await coll.find_one(domain_id, fields)
+    if ddoc and fields is None:
+        smallcache.set_local(smallcache.PREFIX_DOMAIN + domain_id, ddoc)
+    return ddoc
+
+
+async def _unset_cache(ddoc):
+    if ddoc:
+        await smallcache.unset_global(smallcache.PREFIX_DOMAIN + ddoc['_id'])
+    return ddoc
 
 
 def get_multi(*, fields=None, **kwargs):
@@ -56,17 +71,18 @@ async def edit(domain_id: str, **kwargs):
     if 'name' in kwargs:
         validator.check_name(kwargs['name'])
     # TODO: check kwargs.
-    return await coll.find_one_and_update(filter={'_id': domain_id},
-                                          update={'$set': {**kwargs}},
-                                          return_document=True)
+    return await _unset_cache(await coll.find_one_and_update(filter={'_id': domain_id},
+                                                             update={'$set': {**kwargs}},
+                                                             return_document=True))
 
 
 async def unset(domain_id, fields):
     # TODO: check fields.
     coll = db.Collection('domain')
-    return await coll.find_one_and_update(filter={'_id': domain_id},
-                                          update={'$unset': dict((f, '') for f in set(fields))},
-                                          return_document=True)
+    return await _unset_cache(await coll.find_one_and_update(
+        filter={'_id': domain_id},
+        update={'$unset': dict((f, '') for f in set(fields))},
+        return_document=True))
 
 
 @argmethod.wrap
@@ -76,9 +92,10 @@ async def set_role(domain_id: str, role: str, perm: int):
         if domain['_id'] == domain_id:
             return domain
     coll = db.Collection('domain')
-    return await coll.find_one_and_update(filter={'_id': domain_id},
-                                          update={'$set': {'roles.{0}'.format(role): perm}},
-                                          return_document=True)
+    return await _unset_cache(await coll.find_one_and_update(
+        filter={'_id': domain_id},
+        update={'$set': {'roles.{0}'.format(role): perm}},
+        return_document=True))
 
 
 @argmethod.wrap
@@ -97,10 +114,10 @@ async def delete_roles(domain_id: str, roles):
     await user_coll.update_many({'domain_id': domain_id, 'role': {'$in': list(roles)}},
                                 {'$unset': {'role': ''}})
     coll = db.Collection('domain')
-    return await coll.find_one_and_update(filter={'_id': domain_id},
-                                          update={'$unset': dict(('roles.{0}'.format(role), '')
-                                                                 for role in roles)},
-                                          return_document=True)
+    return await _unset_cache(await coll.find_one_and_update(
+        filter={'_id': domain_id},
+        update={'$unset': dict(('roles.{0}'.format(role), '') for role in roles)},
+        return_document=True))
 
 
 @argmethod.wrap
@@ -109,9 +126,10 @@ async def transfer(domain_id: str, old_owner_uid: int, new_owner_uid: int):
         if domain['_id'] == domain_id:
             return None
     coll = db.Collection('domain')
-    return await coll.find_one_and_update(filter={'_id': domain_id, 'owner_uid': old_owner_uid},
-                                          update={'$set': {'owner_uid': new_owner_uid}},
-                                          return_document=True)
+    return await _unset_cache(await coll.find_one_and_update(
+        filter={'_id': domain_id, 'owner_uid': old_owner_uid},
+        update={'$set': {'owner_uid': new_owner_uid}},
+        return_document=True))
 
 
 @argmethod.wrap
@@ -176,6 +194,21 @@ async def inc_user(domain_id, uid, **kwargs):
                                           upsert=True, return_document=True)
 
 
+async def inc_user_multi(key: str, values):
+    """Increase a field of many domain users with one bulk write.
+
+    Args:
+        key: name of the field.
+        values: dict of (domain_id, uid) -> value.
+    """
+    if not values:
+        return
+    coll = db.Collection('domain.user')
+    await coll.bulk_write([UpdateOne({'domain_id': domain_id, 'uid': uid}, {'$inc': {key: value}},
+                                     upsert=True)
+                           for (domain_id, uid), value in values.items()], ordered=False)
+
+
 async def inc_user_usage(domain_id: str, uid: int, usage_field: str, usage: int, quota: int):
     coll = db.Collection('domain.user')
     try:
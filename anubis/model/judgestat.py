@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import datetime
+
+from pymongo import UpdateOne
+
+from anubis import constant
+from anubis import db
+from anubis.util import argmethod
+
+
+GRANULARITY_HOUR = 'hour'
+GRANULARITY_DAY = 'day'
+GRANULARITIES = (GRANULARITY_HOUR, GRANULARITY_DAY)
+
+# Records in these statuses are not judged yet, so they are not counted by the backfill or uncounted.
+PENDING_STATUSES = (constant.record.STATUS_WAITING,
+                    constant.record.STATUS_FETCHED,
+                    constant.record.STATUS_COMPILING,
+                    constant.record.STATUS_JUDGING)
+
+
+def _floor(at, granularity):
+    at = at.replace(minute=0, second=0, microsecond=0)
+    if granularity == GRANULARITY_DAY:
+        at = at.replace(hour=0)
+    return at
+
+
+def _ceil(at, granularity):
+    floor = _floor(at, granularity)
+    if floor == at:
+        return at
+    if granularity == GRANULARITY_DAY:
+        return floor + datetime.timedelta(days=1)
+    return floor + datetime.timedelta(hours=1)
+
+
+@argmethod.wrap
+async def inc(domain_id: str, status: int, count: int=1, *, at: datetime.datetime=None):
+    """Count records entering a status.
+
+    Submissions are counted as entering STATUS_WAITING, judged records as entering their final
+    status at judge_at. A rejudged record is uncounted first, see uncount.
+    """
+    at = at or datetime.datetime.utcnow()
+    coll = db.Collection('judge.stat')
+    await coll.bulk_write([UpdateOne({'granularity': granularity,
+                                      'begin_at': _floor(at, granularity),
+                                      'domain_id': domain_id,
+                                      'status': status},
+                                     {'$inc': {'count': count}},
+                                     upsert=True) for granularity in GRANULARITIES],
+                          ordered=False)
+
+
+async def uncount(rdocs):
+    """Uncount the final statuses of records before they are judged again.
+
+    A judged record is counted as entering its final status at judge_at, as by rebuild, so that
+    the counters keep counting the final status of each record only.
+
+    Args:
+        rdocs: the records as before being reset, with domain_id, status and judge_at.
+    """
+    counts = collections.Counter()
+    for rdoc in rdocs:
+        if rdoc['status'] not in PENDING_STATUSES:
+            at = rdoc.get('judge_at') or rdoc['_id'].generation_time.replace(tzinfo=None)
+            counts[rdoc['domain_id'], rdoc['status'], _floor(at, GRANULARITY_HOUR)] += 1
+    if not counts:
+        return
+    coll = db.Collection('judge.stat')
+    await coll.bulk_write([UpdateOne({'granularity': granularity,
+                                      'begin_at': _floor(at, granularity),
+                                      'domain_id': domain_id,
+                                      'status': status},
+                                     {'$inc': {'count': -count}},
+                                     upsert=True)
+                           for (domain_id, status, at), count in counts.items()
+                           for granularity in GRANULARITIES],
+                          ordered=False)
+
+
+async def _sum(granularity, begin_at, end_at, domain_id, status):
+    if begin_at and end_at and begin_at >= end_at:
+        return 0
+    coll = db.Collection('judge.stat')
+    query = {'granularity': granularity, 'status': status}
+    if begin_at or end_at:
+        query['begin_at'] = {}
+        if begin_at:
+            query['begin_at']['$gte'] = begin_at
+        if end_at:
+            query['begin_at']['$lt'] = end_at
+    if domain_id:
+        query['domain_id'] = domain_id
+    docs = await coll.aggregate([
+        {'$match': query},
+        {'$group': {'_id': None, 'count': {'$sum': '$count'}}}
+    ]).to_list(None)
+    return docs[0]['count'] if docs else 0
+
+
+async def get_count(begin_at: datetime.datetime=None, end_at: datetime.datetime=None, *,
+                    domain_id: str=None, status: int=constant.record.STATUS_WAITING):
+    """Get the number of records entering a status in [begin_at, end_at), precise to an hour.
+
+    Whole days are summed from day buckets and the partial days at both ends from hour buckets.
+    By default, counts submissions of all domains.
+    """
+    if begin_at:
+        begin_at = _floor(begin_at, GRANULARITY_HOUR)
+    if end_at:
+        end_at = _ceil(end_at, GRANULARITY_HOUR)
+    day_begin_at = _ceil(begin_at, GRANULARITY_DAY) if begin_at else None
+    day_end_at = _floor(end_at, GRANULARITY_DAY) if end_at else None
+    if day_begin_at and day_end_at and day_begin_at > day_end_at:
+        # Within a single day.
+        return await _sum(GRANULARITY_HOUR, begin_at, end_at, domain_id, status)
+    coros = [_sum(GRANULARITY_DAY, day_begin_at, day_end_at, domain_id, status)]
+    if begin_at:
+        coros.append(_sum(GRANULARITY_HOUR, begin_at, day_begin_at, domain_id, status))
+    if end_at:
+        coros.append(_sum(GRANULARITY_HOUR, day_end_at, end_at, domain_id, status))
+    return sum(await asyncio.gather(*coros))
+
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def _get_date_parts(date, granularity):
+    parts = {'year': {'$year': date}, 'month': {'$month': date}, 'day': {'$dayOfMonth': date}}
+    if granularity == GRANULARITY_HOUR:
+        parts['hour'] = {'$hour': date}
+    return parts
+
+
+def _get_rebuild_pipeline(granularity):
+    # A record enters STATUS_WAITING when submitted, and its final status when judged.
+    submit_at = {'$toDate': '$_id'}
+    judge_at = {'$ifNull': ['$judge_at', submit_at]}
+    return [
+        {'$project': {'domain_id': 1, 'events': {'$concatArrays': [
+            [{'status': constant.record.STATUS_WAITING, 'at': submit_at}],
+            {'$cond': [{'$in': ['$status', list(PENDING_STATUSES)]},
+                       [],
+                       [{'status': '$status', 'at': judge_at}]]}]}}},
+        {'$unwind': '$events'},
+        {'$group': {'_id': {'domain_id': '$domain_id',
+                            'status': '$events.status',
+                            'begin_at': {'$dateFromParts': _get_date_parts('$events.at', granularity)}},
+                    'count': {'$sum': 1}}},
+    ]
+
+
+@argmethod.wrap
+async def rebuild():
+    """Rebuild the counters from the records. Requires MongoDB 4.0 or later.
+
+    Each granularity is counted by one aggregation over the records, whose groups are streamed
+    into a new collection, which then replaces the counters at once. Records submitted or judged
+    while rebuilding may be counted by the aggregation or not.
+    """
+    tmp_coll = db.Collection('judge.stat.rebuild')
+    await tmp_coll.drop()
+    await _create_indexes(tmp_coll)
+    count = 0
+    for granularity in GRANULARITIES:
+        cursor = db.Collection('record').aggregate(_get_rebuild_pipeline(granularity), allowDiskUse=True,
+                                                   batchSize=REBUILD_BATCH_SIZE)
+        docs = []
+        async for group in cursor:
+            docs.append({'granularity': granularity, 'begin_at': group['_id']['begin_at'],
+                         'domain_id': group['_id']['domain_id'], 'status': group['_id']['status'],
+                         'count': group['count']})
+            if len(docs) >= REBUILD_BATCH_SIZE:
+                await tmp_coll.insert_many(docs, ordered=False)
+                count += len(docs)
+                docs = []
+        if docs:
+            await tmp_coll.insert_many(docs, ordered=False)
+            count += len(docs)
+    await tmp_coll.rename('judge.stat', dropTarget=True)
+    return count
+
+
+async def _create_indexes(coll):
+    await coll.create_index([('granularity', 1),
+                             ('status', 1),
+                             ('begin_at', 1),
+                             ('domain_id', 1)], unique=True)
+
+
+@argmethod.wrap
+async def create_indexes():
+    await _create_indexes(db.Collection('judge.stat'))
+
+
+if __name__ == '__main__':
+    argmethod.invoke_by_args()
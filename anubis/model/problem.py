@@ -3,6 +3,7 @@ import itertools
 
 from bson import objectid
 from pymongo import errors
+from pymongo import UpdateOne
 
 from anubis import constant
 from anubis import db
@@ -132,6 +133,20 @@ async def inc_status(domain_id: str, pid: int, uid: int, key: str, value: int):
     return doc
 
 
+async def inc_status_multi(key: str, values):
+    """Increase a field of many problem statuses with one bulk write.
+
+    Args:
+        key: name of the field.
+        values: dict of (domain_id, pid, uid) -> value.
+    """
+    if not values:
+        return
+    coll = db.Collection('problem.status')
+    await coll.bulk_write([UpdateOne({'domain_id': domain_id, 'pid': pid, 'uid': uid}, {'$inc': {key: value}})
+                           for (domain_id, pid, uid), value in values.items()], ordered=False)
+
+
 def get_multi_status(*, projection=None, **kwargs):
     coll = db.Collection('problem.status')
     return coll.find(kwargs, projection=projection)
@@ -172,6 +187,7 @@ async def set_data(domain_id: str, pid: int, data: objectid.ObjectId):
     pdoc = await edit(domain_id, pid, data=data)
     if not pdoc:
         raise error.ProblemNotFoundError(domain_id, pid)
+    await testdata.unset_answer_cache(domain_id, data)
     return pdoc
 
 
@@ -192,6 +208,20 @@ async def inc(domain_id: str, pid: int, key: str, value: int):
                                           return_document=True)
 
 
+async def inc_multi(key: str, values):
+    """Increase a field of many problems with one bulk write.
+
+    Args:
+        key: name of the field.
+        values: dict of (domain_id, pid) -> value.
+    """
+    if not values:
+        return
+    coll = db.Collection('problem')
+    await coll.bulk_write([UpdateOne({'domain_id': domain_id, '_id': pid}, {'$inc': {key: value}})
+                           for (domain_id, pid), value in values.items()], ordered=False)
+
+
 async def rev_init_status(domain_id, pid, uid):
     coll = db.Collection('problem.status')
     return await coll.find_one_and_update(filter={'domain_id': domain_id,
@@ -1,18 +1,225 @@
+import asyncio
+import collections
+import functools
+import logging
+import time
+
 import bson
 
 from anubis import mq
+from anubis import redis
+from anubis.service import metrics
+from anubis.util import json
+
+_logger = logging.getLogger(__name__)
+
+# Consumers which have not reported for this long are considered gone.
+CONSUMER_TTL_SECONDS = 90
 
 
 async def publish(key, **kwargs):
     channel = await mq.channel('queue')
     await channel.queue_declare(key)
-    await channel.basic_publish(bson.BSON.encode(kwargs), '', key)
+    await metrics.observe('mq', channel.basic_publish(bson.BSON.encode({**kwargs, 'publish_at': time.time()}),
+                                                      '', key))
 
 
-async def consume(key, on_message):
+async def publish_many(key, messages):
+    """Publish messages to a queue, declaring it once.
+
+    Args:
+        key: name of the queue.
+        messages: list of dicts of message fields.
+    """
+    if not messages:
+        return
+    channel = await mq.channel('queue')
+    await channel.queue_declare(key)
+    publish_at = time.time()
+    await metrics.observe('mq', asyncio.gather(*[
+        channel.basic_publish(bson.BSON.encode({**kwargs, 'publish_at': publish_at}), '', key)
+        for kwargs in messages]), len(messages))
+
+
+def _decode(key, body):
+    kwargs = bson.BSON.decode(body)
+    publish_at = kwargs.pop('publish_at', None)
+    if publish_at:
+        metrics.record_histogram('anubis_queue_wait_seconds', max(time.time() - publish_at, 0.0), queue=key)
+    return kwargs
+
+
+async def consume(key, on_message, prefetch_count=1):
     channel = await mq.channel()
     await channel.queue_declare(key)
-    await channel.basic_qos(prefetch_count=1)
+    await channel.basic_qos(prefetch_count=prefetch_count)
     await channel.basic_consume((lambda channel, body, envelope, properties:
-                                 on_message(envelope.delivery_tag, **bson.BSON.decode(body))), key)
+                                 on_message(envelope.delivery_tag, **_decode(key, body))), key)
     return channel
+
+
+class WeightedConsumer(object):
+    """Consumer of several queues, taking messages from them in proportion to their weights.
+
+    At most capacity messages are taken at a time, and each queue has at most one more message
+    delivered and kept in memory, so that the queues with messages can take turns by smooth weighted
+    round robin. A queue without messages gains no credit, so that it does not take a run of turns
+    when messages come.
+
+    To keep one message ahead without holding more, each queue is consumed with a prefetch of one,
+    and consumed again by a new consumer once its message is taken, since the taken message counts
+    against the prefetch of its consumer until acked. This costs a cancel and a consume for each
+    message taken. Still, a consumer holding capacity messages keeps up to one message of each queue
+    from other consumers until it takes it. Holding none would leave the queues to take turns in the
+    order of delivery, and holding more would keep more of them waiting.
+    """
+
+    def __init__(self, channel, weights, on_message, capacity):
+        self.channel = channel
+        self.weights = weights
+        self.on_message = on_message
+        self.capacity = capacity
+        self.tags = set()
+        self._current = dict((key, 0) for key in weights)
+        self._messages = dict((key, collections.deque()) for key in weights)
+        self._consumer_tags = {}  # key -> consumer tag
+        self._renew_locks = dict((key, asyncio.Lock()) for key in weights)
+        # key -> number of renewals of the consumer of the queue not done, after which its next
+        # message is not known yet.
+        self._renewing = collections.Counter()
+
+    async def start(self):
+        # Given to each consumer on the channel, including those of later renewals.
+        await self.channel.basic_qos(prefetch_count=1)
+        for key in self.weights:
+            await self._consume(key)
+
+    async def _consume(self, key):
+        result = await self.channel.basic_consume(functools.partial(self._on_delivery, key), key)
+        self._consumer_tags[key] = result['consumer_tag']
+
+    async def _renew(self, key):
+        try:
+            # One at a time, so that each renewal cancels the consumer of the one before it.
+            async with self._renew_locks[key]:
+                consumer_tag = self._consumer_tags[key]
+                await self._consume(key)
+                # The consumer still holds the taken message, which is acked on the channel.
+                await self.channel.basic_cancel(consumer_tag)
+                # Not dropped by aioamqp. No delivery to the consumer follows the cancel-ok.
+                self.channel.consumer_callbacks.pop(consumer_tag, None)
+        except Exception as e:
+            _logger.warning('Failed to consume queue %s again: %s', key, repr(e))
+        finally:
+            self._renewing[key] -= 1
+
+    async def _on_delivery(self, key, channel, body, envelope, properties):
+        self._messages[key].append((envelope.delivery_tag, body))
+        self._take()
+
+    def _get_key(self):
+        keys = [key for key in self.weights if self._messages[key]]
+        if not keys:
+            return None
+        for key in self.weights:
+            if self._messages[key]:
+                self._current[key] += self.weights[key]
+            elif not self._renewing[key]:
+                self._current[key] = 0
+        key = max(keys, key=lambda key: self._current[key])
+        self._current[key] -= sum(self.weights[k] for k in keys)
+        return key
+
+    def _take(self):
+        while len(self.tags) < self.capacity:
+            key = self._get_key()
+            if not key:
+                break
+            tag, body = self._messages[key].popleft()
+            self.tags.add(tag)
+            self._renewing[key] += 1
+            asyncio.ensure_future(self._renew(key))
+            asyncio.ensure_future(self._deliver(tag, **_decode(key, body)))
+
+    async def _deliver(self, tag, **kwargs):
+        try:
+            await self.on_message(tag, **kwargs)
+        except Exception as e:
+            _logger.exception(e)
+            # Requeue the message, releasing its capacity even if the nack fails.
+            try:
+                await self.channel.basic_client_nack(tag)
+            finally:
+                self._release(tag)
+
+    def _release(self, tag):
+        self.tags.discard(tag)
+        self._take()
+
+    async def ack(self, tag):
+        self._release(tag)
+        await self.channel.basic_client_ack(tag)
+
+    async def nack(self, tag):
+        self._release(tag)
+        await self.channel.basic_client_nack(tag)
+
+    async def close(self):
+        await self.channel.close()
+
+
+async def consume_weighted(weights, on_message, capacity=1):
+    """Consume several queues by weight.
+
+    Args:
+        weights: dict of queue key -> weight.
+        on_message: coroutine function called with the delivery tag and the message.
+        capacity: maximum number of messages taken and not acked or nacked yet.
+
+    Returns:
+        The started WeightedConsumer. Ack or nack messages through it to take the next ones.
+    """
+    channel = await mq.channel()
+    for key in weights:
+        await channel.queue_declare(key)
+    consumer = WeightedConsumer(channel, weights, on_message, capacity)
+    await consumer.start()
+    return consumer
+
+
+async def get_depth(key):
+    """Get the number of messages ready in a queue, not counting those delivered."""
+    channel = await mq.channel('queue')
+    result = await channel.queue_declare(key)
+    return result['message_count']
+
+
+async def set_consumer(key, consumer_id, **kwargs):
+    """Report the status of a consumer of a queue, at least once every CONSUMER_TTL_SECONDS."""
+    db = await redis.database()
+    await db.hset('queue-consumer-' + key, consumer_id, json.encode({**kwargs, 'update_at': time.time()}))
+
+
+async def delete_consumer(key, consumer_id):
+    db = await redis.database()
+    await db.hdel('queue-consumer-' + key, consumer_id)
+
+
+async def get_consumers(key):
+    """Get the status of consumers of a queue of all workers.
+
+    Returns:
+        Dict of consumer id -> status reported by set_consumer.
+    """
+    db = await redis.database()
+    result = {}
+    expired = []
+    for consumer_id, value in (await db.hgetall('queue-consumer-' + key)).items():
+        status = json.decode(value.decode())
+        if status['update_at'] < time.time() - CONSUMER_TTL_SECONDS:
+            expired.append(consumer_id)
+        else:
+            result[consumer_id.decode()] = status
+    if expired:
+        await db.hdel('queue-consumer-' + key, *expired)
+    return result
@@ -1,30 +1,232 @@
 import asyncio
+import collections
 import datetime
+import hashlib
+import logging
+import zlib
+from bson import binary
 from bson import objectid
+from pymongo import errors
+from pymongo import UpdateOne
 
 from anubis import db
 from anubis import constant
+from anubis import error
 from anubis.model import problem
 from anubis.model import contest
 from anubis.model import domain
+from anubis.model import judgestat
 from anubis.model import queue
 from anubis.service import bus
 from anubis.util import argmethod
+from anubis.util import options
 from anubis.util import validator
 from anubis.model.adaptor import judge
 
+options.define('record_batch_window_ms', default=10,
+               help='Time to gather submissions to commit together, in milliseconds.')
+options.define('record_batch_max_submissions', default=100,
+               help='Maximum number of submissions committed together.')
 
-PROJECTION_PUBLIC = {'code': 0}
+_logger = logging.getLogger(__name__)
+
+# code_id is the digest of the code, which tells the code or answer it was taken from.
+PROJECTION_PUBLIC = {'code': 0, 'code_id': 0}
+PROJECTION_LIST = {'code': 0, 'code_id': 0, 'cases': 0, 'judge_texts': 0}
 PROJECTION_ALL = None
 
+QUEUE_CONTEST = 'judge.contest'
+QUEUE_SUBMISSION = 'judge'
+QUEUE_PRETEST = 'judge.pretest'
+QUEUE_REJUDGE = 'judge.rejudge'
+# Judge queue -> weight of taking records from it, when all of them have records.
+QUEUE_WEIGHTS = collections.OrderedDict([
+    (QUEUE_CONTEST, 8),
+    (QUEUE_SUBMISSION, 4),
+    (QUEUE_PRETEST, 2),
+    (QUEUE_REJUDGE, 1),
+])
+
+REJUDGE_BATCH_SIZE = 1000
+REJUDGE_CONCURRENCY = 100
+
+_REJUDGE_UPDATE = {'$unset': {'judge_uid': '',
+                              'judge_at': '',
+                              'compiler_texts': '',
+                              'judge_texts': '',
+                              'cases': ''},
+                   '$set': {'status': constant.record.STATUS_WAITING,
+                            'time_ms': 0,
+                            'memory_kb': 0,
+                            'rejudged': True}}
+
+
+class _Submission(object):
+    def __init__(self, doc, code, enqueue):
+        self.doc = doc
+        self.code = code
+        self.enqueue = enqueue
+        self.future = asyncio.Future()
+
+    def set_result(self, result):
+        # The submitter may be cancelled.
+        if not self.future.done():
+            self.future.set_result(result)
+
+    def set_exception(self, exception):
+        if not self.future.done():
+            self.future.set_exception(exception)
+
+
+# Submissions waiting to be committed in the next batch.
+_submissions = []
+_submissions_handle = None
+
+
+def _get_queue_key(doc):
+    if doc['type'] == constant.record.TYPE_PRETEST:
+        return QUEUE_PRETEST
+    elif doc['tid']:
+        return QUEUE_CONTEST
+    else:
+        return QUEUE_SUBMISSION
+
+
+def _get_write_errors(e):
+    """Get the errors of a bulk write by the index of the failed write."""
+    return dict((write_error['index'],
+                 errors.WriteError(write_error['errmsg'], write_error['code'], write_error))
+                for write_error in e.details['writeErrors'])
+
+
+async def _add_submissions(submissions):
+    """Store the codes and insert the records of submissions.
+
+    A submission whose code or record fails to be written gets its error. A failure of the whole
+    write is raised.
+
+    Returns:
+        List of submissions whose records are inserted.
+    """
+    code_submissions = collections.OrderedDict()  # code id -> submissions
+    for submission in submissions:
+        code_submissions.setdefault(submission.doc['code_id'], []).append(submission)
+    try:
+        await db.Collection('record.code').bulk_write(
+            [_get_code_update(code_id, same_code[0].code) for code_id, same_code in code_submissions.items()],
+            ordered=False)
+    except errors.BulkWriteError as e:
+        same_codes = list(code_submissions.values())
+        failed = set()
+        for index, write_error in _get_write_errors(e).items():
+            # Duplicate keys come from concurrent upserts of the same code.
+            if write_error.code != 11000:
+                for submission in same_codes[index]:
+                    submission.set_exception(write_error)
+                    failed.add(submission)
+        submissions = [submission for submission in submissions if submission not in failed]
+    if not submissions:
+        return []
+    try:
+        await db.Collection('record').insert_many([submission.doc for submission in submissions],
+                                                  ordered=False)
+    except errors.BulkWriteError as e:
+        write_errors = _get_write_errors(e)
+        for index, write_error in write_errors.items():
+            submissions[index].set_exception(write_error)
+        submissions = [submission for index, submission in enumerate(submissions)
+                       if index not in write_errors]
+    return submissions
+
+
+async def _commit_submissions():
+    """Commit the pending submissions with one write per collection.
+
+    Codes are stored by one bulk write and records inserted by one insert_many. Errors of single
+    writes only fail their own submissions. Once a record is inserted, its submission succeeds even
+    if counting or queueing it fails, so that it is not submitted again.
+    """
+    global _submissions, _submissions_handle
+    submissions, _submissions = _submissions, []
+    if _submissions_handle:
+        _submissions_handle.cancel()
+        _submissions_handle = None
+    if not submissions:
+        return
+    try:
+        submissions = await _add_submissions(submissions)
+    except Exception as e:
+        for submission in submissions:
+            submission.set_exception(e)
+        return
+    problem_counts = collections.Counter()
+    status_counts = collections.Counter()
+    user_counts = collections.Counter()
+    domain_counts = collections.Counter()
+    queue_rids = collections.defaultdict(list)
+    for submission in submissions:
+        doc = submission.doc
+        domain_counts[doc['domain_id']] += 1
+        if doc['type'] == constant.record.TYPE_SUBMISSION:
+            problem_counts[(doc['domain_id'], doc['pid'])] += 1
+            status_counts[(doc['domain_id'], doc['pid'], doc['uid'])] += 1
+            user_counts[(doc['domain_id'], doc['uid'])] += 1
+        if submission.enqueue:
+            queue_rids[_get_queue_key(doc)].append({'rid': doc['_id']})
+    try:
+        await asyncio.gather(
+            problem.inc_multi('num_submit', problem_counts),
+            problem.inc_status_multi('num_submit', status_counts),
+            domain.inc_user_multi('num_submit', user_counts),
+            *[judgestat.inc(domain_id, constant.record.STATUS_WAITING, count)
+              for domain_id, count in domain_counts.items()],
+            *[queue.publish_many(key, messages) for key, messages in queue_rids.items()],
+            bus.publish_many('record_change', [submission.doc['_id'] for submission in submissions
+                                               if submission.enqueue]))
+    except Exception as e:
+        # Records not queued stay waiting until rejudged.
+        _logger.exception('Failed to commit submissions %s: %s',
+                          [submission.doc['_id'] for submission in submissions], e)
+    for submission in submissions:
+        submission.set_result(submission.doc['_id'])
+
+
+def _commit_submissions_later():
+    global _submissions_handle
+    _submissions_handle = None
+    asyncio.ensure_future(_commit_submissions())
+
+
+async def _submit(doc, code, enqueue):
+    global _submissions_handle
+    submission = _Submission(doc, code, enqueue)
+    _submissions.append(submission)
+    if len(_submissions) >= options.options.record_batch_max_submissions:
+        asyncio.ensure_future(_commit_submissions())
+    elif not _submissions_handle:
+        _submissions_handle = asyncio.get_event_loop().call_later(
+            options.options.record_batch_window_ms / 1000, _commit_submissions_later)
+    return await submission.future
+
 
 @argmethod.wrap
 async def add(domain_id: str, pid: int, type: int, uid: int, lang: str, code: str,
               data_id: objectid.ObjectId=None, tid: objectid.ObjectId=None,
               hidden=False):
+    """Add a record.
+
+    Submissions arriving within record_batch_window_ms are committed together: codes are stored by
+    one bulk write, records are inserted by one insert_many, counters are increased by one bulk
+    write per collection, and messages are published together. Returns when the record is
+    committed.
+    """
     code = code.strip()
-    coll = db.Collection('record')
-    rid = await coll.insert({
+    pdoc = await problem.get(domain_id=domain_id, pid=pid)
+    answer = pdoc['judge_mode'] == constant.record.MODE_SUBMIT_ANSWER
+    if not answer:
+        validator.check_lang(lang)
+    rid = await _submit({
+        '_id': objectid.ObjectId(),
         'hidden': hidden,
         'status': constant.record.STATUS_WAITING,
         'time_ms': 0,
@@ -33,27 +235,108 @@ async def add(domain_id: str, pid: int, type: int, uid: int, lang: str, code: st
         'pid': pid,
         'uid': uid,
         'lang': lang,
-        'code': code,
+        'code_id': _get_code_id(code),
         'tid': tid,
         'data_id': data_id,
-        'type': type
-    })
-    post_coros = []
-    pdoc = await problem.get(domain_id=domain_id, pid=pid)
-    if pdoc['judge_mode'] == constant.record.MODE_SUBMIT_ANSWER:
+        'type': type,
+    }, code, not answer)
+    if answer:
         await judge.judge_answer(domain_id, rid, pdoc, code)
-    else:
-        validator.check_lang(lang)
-        post_coros.extend([queue.publish('judge', rid=rid),
-                           bus.publish('record_change', rid)])
-    if type == constant.record.TYPE_SUBMISSION:
-        post_coros.extend([problem.inc(domain_id, pid, 'num_submit', 1),
-                           problem.inc_status(domain_id, pid, uid, 'num_submit', 1),
-                           domain.inc_user(domain_id, uid, num_submit=1)])
-    await asyncio.gather(*post_coros)
     return rid
 
 
+async def add_code(code: str):
+    """Store code in the content-addressed code store.
+
+    Returns:
+        The code id, which is the SHA-256 digest of the code.
+    """
+    data = code.encode()
+    code_id = _get_code_id(code)
+    coll = db.Collection('record.code')
+    try:
+        await coll.update_one({'_id': code_id},
+                              {'$setOnInsert': {'data': binary.Binary(zlib.compress(data)),
+                                                'size': len(data)}},
+                              upsert=True)
+    except errors.DuplicateKeyError:
+        # Inserted by a concurrent upsert of the same code.
+        pass
+    return code_id
+
+
+def _get_code_id(code):
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def _get_code_update(code_id, code):
+    data = code.encode()
+    return UpdateOne({'_id': code_id},
+                     {'$setOnInsert': {'data': binary.Binary(zlib.compress(data)), 'size': len(data)}},
+                     upsert=True)
+
+
+def _decompress_code(cdoc):
+    return zlib.decompress(cdoc['data']).decode()
+
+
+async def get_code(rdoc):
+    """Get the code of a record, which needs either code or code_id in the record document."""
+    if 'code' in rdoc:
+        # Not migrated yet.
+        return rdoc['code']
+    coll = db.Collection('record.code')
+    cdoc = await coll.find_one(rdoc['code_id'])
+    if not cdoc:
+        _logger.error('Code %s of record %s not found', rdoc['code_id'], rdoc['_id'])
+        return ''
+    return _decompress_code(cdoc)
+
+
+async def get_code_dict(rdocs):
+    """Get the code of records in one query.
+
+    Returns:
+        Dict of record id -> code.
+    """
+    result = {}
+    code_ids = {}
+    for rdoc in rdocs:
+        if 'code' in rdoc:
+            result[rdoc['_id']] = rdoc['code']
+        else:
+            code_ids.setdefault(rdoc['code_id'], []).append(rdoc['_id'])
+    if code_ids:
+        async for cdoc in db.Collection('record.code').find({'_id': {'$in': list(code_ids)}}):
+            for rid in code_ids.pop(cdoc['_id']):
+                result[rid] = _decompress_code(cdoc)
+    for code_id, rids in code_ids.items():
+        _logger.error('Code %s of records %s not found', code_id, rids)
+        for rid in rids:
+            result[rid] = ''
+    return result
+
+
+@argmethod.wrap
+async def migrate_code(batch_size: int=1000):
+    """Move the code embedded in records to the code store, walking the records in _id order."""
+    coll = db.Collection('record')
+    num_records = 0
+    query = {'code': {'$exists': True}}
+    while True:
+        rdocs = await coll.find(query, {'code': 1}).sort('_id', 1).limit(batch_size).to_list(None)
+        if not rdocs:
+            break
+        query['_id'] = {'$gt': rdocs[-1]['_id']}
+        code_ids = await asyncio.gather(*[add_code(rdoc['code']) for rdoc in rdocs])
+        await coll.bulk_write([UpdateOne({'_id': rdoc['_id']},
+                                         {'$set': {'code_id': code_id}, '$unset': {'code': ''}})
+                               for rdoc, code_id in zip(rdocs, code_ids)], ordered=False)
+        num_records += len(rdocs)
+        _logger.info('Migrated code of %d records', num_records)
+    return num_records
+
+
 @argmethod.wrap
 async def get(record_id: objectid.ObjectId, projection=PROJECTION_ALL):
     coll = db.Collection('record')
@@ -70,51 +353,141 @@ async def remove_property(record_id: objectid.ObjectId, property_name: str):
 async def rejudge(record_id: objectid.ObjectId, enqueue: bool=True):
     coll = db.Collection('record')
     doc = await coll.find_one_and_update(filter={'_id': record_id},
-                                         update={'$unset': {'judge_uid': '',
-                                                            'judge_at': '',
-                                                            'compiler_texts': '',
-                                                            'judge_texts': '',
-                                                            'cases': ''},
-                                                 '$set': {'status': constant.record.STATUS_WAITING,
-                                                          'time_ms': 0,
-                                                          'memory_kb': 0,
-                                                          'rejudged': True}},
+                                         update=_REJUDGE_UPDATE,
                                          return_document=False)
-    post_coros = []
+    post_coros = [judgestat.uncount([doc])]
     pdoc = await problem.get(doc['domain_id'], doc['pid'])
     if pdoc['judge_mode'] == constant.record.MODE_SUBMIT_ANSWER:
-        await judge.judge_answer(doc['domain_id'], record_id, pdoc, doc['code'])
+        await judge.judge_answer(doc['domain_id'], record_id, pdoc, await get_code(doc))
     else:
         post_coros.append(bus.publish('record_change', doc['_id']))
         if enqueue:
-            post_coros.append(queue.publish('judge', rid=doc['_id']))
+            # A single rejudge is asked for by hand, so it is not put behind rejudges of many records.
+            post_coros.append(queue.publish(QUEUE_SUBMISSION, rid=doc['_id']))
     await asyncio.gather(*post_coros)
 
 
+async def _rejudge_batch(rdocs, pdocs, semaphore):
+    for rdoc in rdocs:
+        key = (rdoc['domain_id'], rdoc['pid'])
+        if key not in pdocs:
+            try:
+                pdocs[key] = await problem.get(*key)
+            except error.ProblemNotFoundError:
+                pdocs[key] = None
+    # Records of problems deleted are skipped, rather than reset and never judged.
+    skipped_rids = [rdoc['_id'] for rdoc in rdocs if not pdocs[(rdoc['domain_id'], rdoc['pid'])]]
+    if skipped_rids:
+        _logger.warning('Rejudge skipped records of problems not found: %s', skipped_rids)
+        rdocs = [rdoc for rdoc in rdocs if pdocs[(rdoc['domain_id'], rdoc['pid'])]]
+        if not rdocs:
+            return
+    coll = db.Collection('record')
+    await coll.update_many({'_id': {'$in': [rdoc['_id'] for rdoc in rdocs]}}, _REJUDGE_UPDATE)
+    await judgestat.uncount(rdocs)
+    answer_rids = [rdoc['_id'] for rdoc in rdocs
+                   if (pdocs[(rdoc['domain_id'], rdoc['pid'])]['judge_mode']
+                       == constant.record.MODE_SUBMIT_ANSWER)]
+    codes = {}
+    if answer_rids:
+        codes = await get_code_dict(await coll.find({'_id': {'$in': answer_rids}},
+                                                    {'code': 1, 'code_id': 1}).to_list(None))
+
+    async def enqueue(rdoc):
+        async with semaphore:
+            if rdoc['_id'] in codes:
+                await judge.judge_answer(rdoc['domain_id'], rdoc['_id'],
+                                         pdocs[(rdoc['domain_id'], rdoc['pid'])], codes[rdoc['_id']])
+            else:
+                await queue.publish(QUEUE_REJUDGE, rid=rdoc['_id'])
+
+    await asyncio.gather(*[enqueue(rdoc) for rdoc in rdocs])
+
+
 @argmethod.wrap
-async def rejudge_all():
+async def rejudge_multi(job_id: objectid.ObjectId=None, *, batch_size: int=REJUDGE_BATCH_SIZE,
+                        concurrency: int=REJUDGE_CONCURRENCY, **kwargs):
+    """Rejudge the records matching kwargs, or resume an interrupted rejudge job.
+
+    Only the ids of the records are streamed, in _id order. Each batch is reset by one update_many
+    and enqueued with bounded concurrency. Progress is saved in the record.rejudge collection after
+    every batch, so the job can be resumed by its id. Records submitted after the job starts are
+    not rejudged. No record_change is published; the record lists are updated when judging begins.
+
+    Returns:
+        The id of the job.
+    """
     coll = db.Collection('record')
-    records = await coll.find().to_list(None)
-    for record in records:
-        await rejudge(record['_id'])
+    jcoll = db.Collection('record.rejudge')
+    if job_id:
+        jdoc = await jcoll.find_one(job_id)
+        if not jdoc:
+            raise error.RejudgeJobNotFoundError(job_id)
+    else:
+        last_rdocs = await coll.find(kwargs, {'_id': 1}).sort([('_id', -1)]).limit(1).to_list(None)
+        jdoc = {'query': kwargs,
+                'end_id': last_rdocs[0]['_id'] if last_rdocs else None,
+                'last_id': None,
+                'total': await coll.find(kwargs).count(),
+                'done': 0,
+                'begin_at': datetime.datetime.utcnow(),
+                'end_at': None}
+        await jcoll.insert_one(jdoc)
+    if not jdoc['end_id']:
+        await jcoll.update_one({'_id': jdoc['_id']}, {'$set': {'end_at': datetime.datetime.utcnow()}})
+        return jdoc['_id']
+    pdocs = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    while True:
+        # The condition on hidden makes the scan walk one of the (hidden, ..., _id) indexes.
+        query = {'hidden': {'$in': [False, True]}, **jdoc['query'], '_id': {'$lte': jdoc['end_id']}}
+        if jdoc['last_id']:
+            query['_id']['$gt'] = jdoc['last_id']
+        rdocs = await coll.find(query, {'_id': 1, 'domain_id': 1, 'pid': 1, 'status': 1, 'judge_at': 1}) \
+                          .sort([('_id', 1)]).limit(batch_size).to_list(None)
+        if not rdocs:
+            break
+        await _rejudge_batch(rdocs, pdocs, semaphore)
+        jdoc['last_id'] = rdocs[-1]['_id']
+        jdoc['done'] += len(rdocs)
+        await jcoll.update_one({'_id': jdoc['_id']}, {'$set': {'last_id': jdoc['last_id'],
+                                                               'done': jdoc['done']}})
+        _logger.info('Rejudge %s: %d/%d', jdoc['_id'], jdoc['done'], jdoc['total'])
+    await jcoll.update_one({'_id': jdoc['_id']}, {'$set': {'end_at': datetime.datetime.utcnow()}})
+    return jdoc['_id']
+
+
+@argmethod.wrap
+def get_rejudge_jobs(unfinished: bool=False):
+    """Get rejudge jobs with their progress, the latest first."""
+    query = {'end_at': None} if unfinished else {}
+    return db.Collection('record.rejudge').find(query).sort([('_id', -1)])
+
+
+@argmethod.wrap
+async def rejudge_all():
+    return await rejudge_multi()
 
 
 @argmethod.wrap
 async def rejudge_for_contest(domain_id: str, tid: int):
-    async for rdoc in get_multi(domain_id=domain_id, tid=tid, type=constant.record.TYPE_SUBMISSION):
-        await rejudge(rdoc['_id'])
+    return await rejudge_multi(domain_id=domain_id, tid=tid, type=constant.record.TYPE_SUBMISSION)
 
 
 @argmethod.wrap
 async def rejudge_problem_for_contest(domain_id: str, tid: int, pid: int):
-    async for rdoc in get_multi(domain_id=domain_id, tid=tid, pid=pid, type=constant.record.TYPE_SUBMISSION):
-        await rejudge(rdoc['_id'])
+    return await rejudge_multi(domain_id=domain_id, tid=tid, pid=pid, type=constant.record.TYPE_SUBMISSION)
 
 
 @argmethod.wrap
 def get_all_multi(end_id: objectid.ObjectId=None, get_hidden: bool=False, *, projection=None, **kwargs):
+    """Get records, sort by _id descending to walk one of the (hidden, ..., _id) indexes.
+
+    Pass the _id of the last record of a page as end_id to get the next page.
+    """
     coll = db.Collection('record')
-    query = {**kwargs, 'hidden': False if not get_hidden else {'$gte': False}}
+    # $in instead of a range on hidden lets the server merge the index ranges in _id order.
+    query = {**kwargs, 'hidden': False if not get_hidden else {'$in': [False, True]}}
     if end_id:
         query['_id'] = {'$lt': end_id}
     return coll.find(query, projection=projection)
@@ -181,8 +554,13 @@ async def begin_judge(record_id: objectid.ObjectId, judge_uid: int, status: int)
 
 @argmethod.wrap
 async def next_judge(record_id: objectid.ObjectId, judge_uid: int, **kwargs):
+    """Update a record being judged by the judge, doing nothing once it is ended or taken by another."""
     coll = db.Collection('record')
-    doc = await coll.find_one_and_update(filter={'_id': record_id},
+    doc = await coll.find_one_and_update(filter={'_id': record_id,
+                                                 'judge_uid': judge_uid,
+                                                 'status': {'$in': [constant.record.STATUS_FETCHED,
+                                                                    constant.record.STATUS_COMPILING,
+                                                                    constant.record.STATUS_JUDGING]}},
                                          update=kwargs,
                                          return_document=True)
     return doc
@@ -212,6 +590,31 @@ async def create_indexes():
     await coll.create_index([('hidden', 1),
                              ('domain_id', 1),
                              ('pid', 1),
+                             ('_id', -1)])
+    await coll.create_index([('hidden', 1),
+                             ('domain_id', 1),
+                             ('pid', 1),
+                             ('uid', 1),
+                             ('_id', -1)])
+    # for contest record list
+    await coll.create_index([('hidden', 1),
+                             ('domain_id', 1),
+                             ('tid', 1),
+                             ('_id', -1)])
+    await coll.create_index([('hidden', 1),
+                             ('domain_id', 1),
+                             ('tid', 1),
+                             ('uid', 1),
+                             ('_id', -1)])
+    await coll.create_index([('hidden', 1),
+                             ('domain_id', 1),
+                             ('tid', 1),
+                             ('pid', 1),
+                             ('_id', -1)])
+    await coll.create_index([('hidden', 1),
+                             ('domain_id', 1),
+                             ('tid', 1),
+                             ('pid', 1),
                              ('uid', 1),
                              ('_id', -1)])
     # for job record
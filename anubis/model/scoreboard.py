@@ -0,0 +1,313 @@
+import asyncio
+import bisect
+import collections
+import heapq
+
+from bson import objectid
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
+
+from anubis import db
+from anubis import error
+from anubis.model import contest
+from anubis.service import bus
+from anubis.util import argmethod
+from anubis.util import json
+from anubis.util import options
+from anubis.util import scoring
+
+options.define('scoreboard_max_contests', default=16,
+               help='Maximum number of contest scoreboards kept in memory by a worker.')
+
+_scoreboards = collections.OrderedDict()  # (domain_id, tid) -> future of Scoreboard
+
+
+def _journal_key(jdoc):
+    return jdoc['rid']
+
+
+def _set_balloons(tsdoc, stats):
+    """Keep the balloons of the row of a team in its new stats."""
+    balloons = dict((d['pid'], d.get('balloon', False)) for d in tsdoc.get('detail', []))
+    for d in stats['detail']:
+        d['balloon'] = balloons.get(d['pid'], False)
+    return stats
+
+
+class Scoreboard(object):
+    """Scoreboard of a contest kept in memory.
+
+    The journal of each team is kept by problem, so that a judged record only recomputes the cell of
+    its problem. Teams are kept in a list sorted by the status sort of the rule, in which a team is
+    found by bisection in O(log n), and moved by a list deletion and insertion in O(n).
+    """
+
+    def __init__(self, tdoc):
+        self.tdoc = tdoc
+        self.rule = contest.RULES[tdoc['rule']]
+        self.lock = asyncio.Lock()
+        self.tsdocs = {}  # uid -> tsdoc
+        self.journals = {}  # uid -> pid -> journal sorted by rid
+        self.cells = {}  # uid -> pid -> stats of the problem
+        self.keys = []  # sorted rank keys
+        self.unranked_keys = []  # sorted rank keys of teams not ranked
+        self.rev = 0  # revision of the status of the contest applied
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _get_key(self, tsdoc):
+        key = []
+        for field, direction in self.rule.status_sort:
+            # Missing fields are stats of a team without judged records, counted as 0 as in the rank
+            # functions, so that the team is tied with those of 0.
+            value = tsdoc.get(field, 0)
+            key.append(-value if direction < 0 else value)
+        key.append(tsdoc['uid'])
+        return tuple(key)
+
+    def _remove(self, uid):
+        tsdoc = self.tsdocs.pop(uid, None)
+        if tsdoc:
+            key = self._get_key(tsdoc)
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            if not tsdoc.get('ranked', True):
+                del self.unranked_keys[bisect.bisect_left(self.unranked_keys, key)]
+
+    def set(self, tsdoc):
+        """Set the row of a team, keeping the stats stored in it."""
+        self._remove(tsdoc['uid'])
+        self.tsdocs[tsdoc['uid']] = tsdoc
+        key = self._get_key(tsdoc)
+        bisect.insort(self.keys, key)
+        if not tsdoc.get('ranked', True):
+            bisect.insort(self.unranked_keys, key)
+
+    def load(self, tsdoc):
+        """Load the row of a team, and recompute the cells of the team from its journal."""
+        journals = collections.defaultdict(list)
+        for jdoc in scoring.uniquify_journal(tsdoc.get('journal', [])):
+            journals[jdoc['pid']].append(jdoc)
+        self.journals[tsdoc['uid']] = dict(journals)
+        self.cells[tsdoc['uid']] = dict((pid, self.rule.stat_func(self.tdoc, journal))
+                                        for pid, journal in journals.items())
+        self.set(tsdoc)
+
+    def unload(self, uid):
+        self._remove(uid)
+        self.journals.pop(uid, None)
+        self.cells.pop(uid, None)
+
+    def get_update(self, uid):
+        """Get the fields of the row of a team computed from the cells in memory."""
+        cells = self.cells[uid]
+        stats = {'detail': []}
+        for pid in self.tdoc['pids']:
+            for key, value in cells.get(pid, {}).items():
+                if key == 'detail':
+                    stats['detail'].extend(dict(d) for d in value)
+                else:
+                    stats[key] = stats.get(key, 0) + value
+        return {'journal': list(heapq.merge(*self.journals[uid].values(), key=_journal_key)),
+                **_set_balloons(self.tsdocs[uid], stats)}
+
+    def apply(self, uid, jdoc):
+        """Apply a judged record to the cells of a team.
+
+        The row is not changed until the update is written and set back. If it is not written, the
+        cells are recomputed from the row by load.
+
+        Returns:
+            The update of the row, see get_update.
+        """
+        journal = [j for j in self.journals[uid].get(jdoc['pid'], []) if j['rid'] != jdoc['rid']]
+        journal.append(jdoc)
+        journal.sort(key=_journal_key)
+        self.journals[uid][jdoc['pid']] = journal
+        self.cells[uid][jdoc['pid']] = self.rule.stat_func(self.tdoc, journal)
+        return self.get_update(uid)
+
+    def get_rank(self, uid):
+        """Get the 1-based position of a team in the sorted rows, or None if not found.
+
+        Unranked teams are counted, see rank_func of the rule for the displayed ranks.
+        """
+        if uid not in self.tsdocs:
+            return None
+        return bisect.bisect_left(self.keys, self._get_key(self.tsdocs[uid])) + 1
+
+    def get_tsdocs(self, offset=0, limit=None):
+        """Get copies of the rows of teams sorted by the status sort of the rule."""
+        end = offset + limit if limit is not None else None
+        return [dict(self.tsdocs[key[-1]]) for key in self.keys[offset:end]]
+
+    def get_key(self, uid):
+        """Get the rank key of the row of a team, or None if not found."""
+        if uid not in self.tsdocs:
+            return None
+        return self._get_key(self.tsdocs[uid])
+
+    def _get_tie_end(self, key):
+        """Get the position of the last team tied with a rank key."""
+        return bisect.bisect_left(self.keys, key[:-1] + (float('inf'),))
+
+    def get_delta(self, uid, old_key):
+        """Get the change of the scoreboard after the row of a team moved from old_key.
+
+        Returns:
+            Dict of the row of the team without its journal, its new position, and the ranks and
+            prizes of the teams whose ranks may have changed: those between the old and new
+            positions, and those tied with the team before or after it moved.
+        """
+        key = self.get_key(uid)
+        old_key = old_key or key
+        position = bisect.bisect_left(self.keys, key) + 1
+        old_position = bisect.bisect_left(self.keys, old_key) + (0 if key < old_key else 1)
+        begin = min(old_position, position)
+        end = max(old_position, position, self._get_tie_end(old_key), self._get_tie_end(key))
+        # Rank from the first team tied with the one at begin, after the ranked teams before it.
+        start = bisect.bisect_left(self.keys, self.keys[begin - 1][:-1])
+        num_ranked = start - bisect.bisect_left(self.unranked_keys, self.keys[start])
+        ranked = list(self.rule.rank_func(self.get_tsdocs(start, end - start), start=num_ranked + 1))
+        tsdoc = ranked[position - 1 - start][1]
+        tsdoc.pop('journal', None)
+        return {'uid': uid, 'position': position, 'tsdoc': tsdoc,
+                'ranks': [{'uid': t['uid'], 'rank': rank, 'prize': t.get('prize')}
+                          for rank, t in ranked[begin - 1 - start:]]}
+
+    async def reload(self, uid):
+        tsdoc = await contest.get_status(self.tdoc['domain_id'], self.tdoc['_id'], uid)
+        if tsdoc:
+            self.load(tsdoc)
+        else:
+            self.unload(uid)
+        return tsdoc
+
+
+async def _load(domain_id, tid):
+    scoreboard = Scoreboard(await contest.get(domain_id, tid))
+    # Read before the rows, so that the rows are at least at this revision.
+    scoreboard.rev = await contest.get_status_rev(tid)
+    async for tsdoc in contest.get_multi_status(domain_id=domain_id, tid=tid):
+        scoreboard.load(tsdoc)
+    return scoreboard
+
+
+async def get(domain_id, tid):
+    """Get the scoreboard of a contest, loading it into memory if it is not."""
+    key = (domain_id, tid)
+    if key in _scoreboards:
+        _scoreboards.move_to_end(key)
+    else:
+        _scoreboards[key] = asyncio.ensure_future(_load(domain_id, tid))
+        if len(_scoreboards) > options.options.scoreboard_max_contests:
+            _scoreboards.popitem(False)
+    future = _scoreboards[key]
+    try:
+        return await asyncio.shield(future)
+    except Exception:
+        if _scoreboards.get(key) is future:
+            del _scoreboards[key]
+        raise
+
+
+async def _on_status_change(e):
+    value = json.decode(e['value'])
+    key = (value['domain_id'], value['tid'])
+    if key not in _scoreboards:
+        return
+    if value['uid'] is None:
+        del _scoreboards[key]
+        return
+    try:
+        scoreboard = await asyncio.shield(_scoreboards[key])
+    except Exception:
+        return
+    async with scoreboard.lock:
+        tsdoc = scoreboard.tsdocs.get(value['uid'])
+        if value['rev'] is None or not tsdoc or tsdoc.get('rev') != value['rev']:
+            await scoreboard.reload(value['uid'])
+        scoreboard.rev = max(scoreboard.rev, value['contest_rev'])
+
+
+def init():
+    bus.subscribe(_on_status_change, ['contest_status_change'])
+
+
+@argmethod.wrap
+async def update_status(domain_id: str, tid: int, uid: int, rid: objectid.ObjectId,
+                        pid: int, accept: bool, score: int=0):
+    """Apply a judged record to the scoreboard, writing back the row of the team only.
+
+    The row is written with the revision it was read at. If another worker changed it in between,
+    the row is read again and the record applied again. The change of the scoreboard is pushed to
+    contest_notification-<tid> as a row_changed delta, and the first accept of a problem by the team
+    is queued in contest.balloon.
+    """
+    scoreboard = await get(domain_id, tid)
+    if pid not in scoreboard.tdoc['pids']:
+        raise error.ValidationError('pid')
+    jdoc = {'rid': rid, 'pid': pid, 'accept': accept, 'score': score}
+    coll = db.Collection('contest.status')
+    async with scoreboard.lock:
+        while True:
+            tsdoc = scoreboard.tsdocs.get(uid) or await scoreboard.reload(uid)
+            if not tsdoc:
+                return {}
+            if not tsdoc.get('attend'):
+                raise error.ContestNotAttendedError(domain_id, tid, uid)
+            accepted = any(d['pid'] == pid and d['accept'] for d in tsdoc.get('detail', []))
+            old_key = scoreboard.get_key(uid)
+            update = scoreboard.apply(uid, jdoc)
+            try:
+                tsdoc = await coll.find_one_and_update(filter={'domain_id': domain_id,
+                                                               'tid': tid,
+                                                               'uid': uid,
+                                                               'rev': tsdoc.get('rev')},
+                                                       update={'$set': update,
+                                                               '$inc': {'rev': 1}},
+                                                       return_document=ReturnDocument.AFTER)
+                if not tsdoc:
+                    # Changed by another worker.
+                    await scoreboard.reload(uid)
+            except BaseException:
+                # Not written, so the cells go back to those of the row in memory, which the
+                # record is not applied to.
+                scoreboard.load(scoreboard.tsdocs[uid])
+                raise
+            if tsdoc:
+                scoreboard.set(tsdoc)
+                break
+        contest_rev = await contest.publish_status_change(domain_id, tid, uid, tsdoc['rev'])
+        scoreboard.rev = max(scoreboard.rev, contest_rev)
+        delta = scoreboard.get_delta(uid, old_key)
+    await bus.publish('contest_notification-' + str(tid),
+                      json.encode({'type': 'row_changed', 'rev': contest_rev, **delta}))
+    if accept and not accepted:
+        tsdoc = await contest.set_status_balloon(domain_id, tid, uid, pid, False)
+    return tsdoc
+
+
+@argmethod.wrap
+async def rebuild(domain_id: str, tid: int):
+    """Recompute the rows of all teams of a contest from their journals, for recovery.
+
+    The stats of all teams are computed at once by stat_multi_func of the rule. Scoreboards in memory
+    of all workers are dropped and loaded again on their next use.
+    """
+    tdoc = await contest.get(domain_id, tid)
+    tsdocs = await contest.get_multi_status(domain_id=domain_id, tid=tid).to_list(None)
+    journals = [scoring.uniquify_journal(tsdoc.get('journal', [])) for tsdoc in tsdocs]
+    updates = [UpdateOne({'_id': tsdoc['_id']},
+                         {'$set': {'journal': journal, **_set_balloons(tsdoc, stats)}, '$inc': {'rev': 1}})
+               for tsdoc, journal, stats in zip(tsdocs, journals,
+                                                contest.RULES[tdoc['rule']].stat_multi_func(tdoc, journals))]
+    if updates:
+        await db.Collection('contest.status').bulk_write(updates, ordered=False)
+    await asyncio.gather(
+        contest.publish_status_change(domain_id, tid),
+        bus.publish('contest_notification-' + str(tid), json.encode({'type': 'rank_changed'})))
+    return len(updates)
+
+if __name__ == '__main__':
+    argmethod.invoke_by_args()
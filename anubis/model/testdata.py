@@ -1,6 +1,7 @@
 from bson import objectid
 
 from anubis import db
+from anubis.service import smallcache
 from anubis.util import argmethod
 
 TYPE_TEST_DATA = 1
@@ -28,6 +29,15 @@ async def get(domain_id: str, did: objectid.ObjectId):
                                 '_id': did})
 
 
+def get_answer_cache_key(domain_id, did):
+    """Get the smallcache key of the reference answer digest of test data."""
+    return '{0}{1}-{2}'.format(smallcache.PREFIX_ANSWER, domain_id, did)
+
+
+async def unset_answer_cache(domain_id, did):
+    await smallcache.unset_global(get_answer_cache_key(domain_id, did))
+
+
 @argmethod.wrap
 async def edit(domain_id: str, did: objectid.ObjectId, **kwargs):
     coll = db.Collection('testdata')
@@ -35,14 +45,17 @@ async def edit(domain_id: str, did: objectid.ObjectId, **kwargs):
                                                  '_id': did},
                                          update={'$set': kwargs},
                                          return_document=True)
+    await unset_answer_cache(domain_id, did)
     return doc
 
 
 @argmethod.wrap
 async def delete(domain_id: str, did: objectid.ObjectId):
     coll = db.Collection('testdata')
-    return await coll.delete_one({'domain_id': domain_id,
-                                  '_id': did})
+    result = await coll.delete_one({'domain_id': domain_id,
+                                    '_id': did})
+    await unset_answer_cache(domain_id, did)
+    return result
 
 
 @argmethod.wrap
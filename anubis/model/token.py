@@ -18,6 +18,10 @@ def _get_id(id_binary):
     return hashlib.sha256(id_binary).digest()
 
 
+def _decode(doc):
+    return json.decode(doc.decode()) if doc else None
+
+
 @argmethod.wrap
 async def add(token_type: int, expire_seconds: int, **kwargs):
     """Add a token.
@@ -57,11 +61,7 @@ async def get(token_id: str, token_type: int):
         The token document, or None.
     """
     db = await redis.database()
-    doc = await db.get('token_' + token_id)
-    if doc:
-        return json.decode(doc.decode())
-    else:
-        return None
+    return _decode(await db.get('token_' + token_id))
 
 
 @argmethod.wrap
@@ -98,6 +98,48 @@ async def update(token_id: str, token_type: int, expire_seconds: int, replace: b
     return doc
 
 
+@argmethod.wrap
+async def refresh(token_id: str, token_type: int, expire_seconds: int, refresh_ratio: float, **kwargs):
+    """Refresh a sliding token, rewriting it only when necessary.
+
+    The token and the time to live of its key are read in one round trip. The token is only
+    rewritten when the extra data differs from the stored one, or when the last refresh, told by the
+    time to live, is older than refresh_ratio * expire_seconds. The key expiry is only moved by the
+    rewrite, so that it stays equal to the stored expire_at and the cookie.
+
+    Args:
+        token_id: token ID.
+        token_type: type of the token.
+        expire_seconds: expire time, in seconds.
+        refresh_ratio: fraction of the expire time after which the token is rewritten anyway.
+        **kwargs: extra data.
+
+    Returns:
+        Tuple of (token document, whether the token is rewritten), or (None, False).
+    """
+    db = await redis.database()
+    doc, ttl = await db.pipeline(('get', 'token_' + token_id), ('ttl', 'token_' + token_id))
+    doc = _decode(doc)
+    if not doc:
+        return None, False
+    for key in ['create_at', 'update_at', 'expire_at']:
+        if key in doc:
+            doc[key] = datetime.datetime.utcfromtimestamp(doc[key] / 1000)
+    now = datetime.datetime.utcnow()
+    if (doc.get('token_type') == token_type
+            and all(doc.get(key) == value for key, value in kwargs.items())
+            and ttl > expire_seconds * (1 - refresh_ratio)):
+        return doc, False
+    # Written from the document read, which update would read again. A key without expiry, whose
+    # time to live is negative, is rewritten with one.
+    doc.update({**kwargs,
+                'token_type': token_type,
+                'update_at': now,
+                'expire_at': now + datetime.timedelta(seconds=expire_seconds)})
+    await db.set('token_' + token_id, json.encode(doc), expire=expire_seconds)
+    return doc, True
+
+
 @argmethod.wrap
 async def delete(token_id: str, token_type: int):
     """Delete a token.
@@ -1,23 +1,127 @@
+import asyncio
+import functools
+import time
+
 import aioredis
 
+from anubis.service import metrics
 from anubis.util import options
 
 
 options.define('redis_host', default='localhost', help='Redis hostname or IP address.')
 options.define('redis_port', default=6379, help='Redis port.')
 options.define('redis_index', default=1, help='Redis database index.')
+options.define('redis_pool_min', default=1, help='Minimum number of Redis connections per worker.')
+options.define('redis_pool_max', default=8, help='Maximum number of Redis connections per worker.')
+
+_database_future = None
+_stats = {'commands': 0, 'in_flight': 0, 'errors': 0, 'latency_seconds': 0.0}
+
+
+class _Database(object):
+    """Pooled Redis client which keeps statistics of every command it executes."""
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    @property
+    def closed(self):
+        return self._redis.closed
+
+    def __getattr__(self, name):
+        attr = getattr(self._redis, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def wrapped(*args, **kwargs):
+            return await _timed(attr(*args, **kwargs))
+
+        return wrapped
+
+    async def pipeline(self, *commands):
+        """Execute commands in a single round trip.
+
+        Args:
+            commands: tuples of (command name, arg, ...), e.g. ('get', key).
 
-_connection = None
+        Returns:
+            List of results, in the order of the commands.
+        """
+        pipe = self._redis.pipeline()
+        futures = [getattr(pipe, command[0])(*command[1:]) for command in commands]
+        await _timed(pipe.execute(), len(commands))
+        return [future.result() for future in futures]
 
 
-async def _create_connect():
-    global _connection
-    if not _connection:
-        _connection = await aioredis.create_redis(
+async def _timed(coro, num_commands=1):
+    _stats['commands'] += num_commands
+    _stats['in_flight'] += 1
+    start = time.perf_counter()
+    try:
+        return await coro
+    except Exception:
+        _stats['errors'] += 1
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        _stats['in_flight'] -= 1
+        _stats['latency_seconds'] += seconds
+        metrics.record_call('redis', seconds, num_commands)
+
+
+async def _connect():
+    global _database_future
+    if _database_future:
+        database = await _database_future
+        if not database.closed:
+            return database
+        _database_future = None
+    _database_future = future = asyncio.Future()
+    try:
+        redis = await aioredis.create_redis_pool(
             (options.options.redis_host, options.options.redis_port),
-            db=options.options.redis_index
+            db=options.options.redis_index,
+            minsize=options.options.redis_pool_min,
+            maxsize=options.options.redis_pool_max
         )
-    return _connection
+        database = _Database(redis)
+        metrics.add_gauge('anubis_redis_pool',
+                          'Statistics of the Redis connection pool of the worker rendering the metrics.',
+                          _collect_stats)
+        future.set_result(database)
+        return database
+    except Exception as e:
+        future.set_exception(e)
+        _database_future = None
+        raise
+
 
 async def database():
-    return await _create_connect()
+    return await _connect()
+
+
+def stats():
+    """Get statistics of the Redis connection pool of this worker.
+
+    Returns:
+        Dict of pool size, free and in-use connections, callers waiting for a connection, commands
+        in flight, total number of commands, total number of errors and total latency in seconds.
+    """
+    result = dict(_stats)
+    if _database_future and _database_future.done() and not _database_future.exception():
+        pool = _database_future.result().connection
+        result.update({'size': pool.size, 'free': pool.freesize, 'in_use': pool.size - pool.freesize,
+                       'minsize': pool.minsize, 'maxsize': pool.maxsize, 'waiting': _get_waiting(pool)})
+    return result
+
+
+def _get_waiting(pool):
+    # The pool has no public count of its waiters. In aioredis 1.x, pinned in requirements.txt, they
+    # wait on the asyncio.Condition _cond of ConnectionsPool for a free connection.
+    cond = getattr(pool, '_cond', None)
+    return len(getattr(cond, '_waiters', None) or ())
+
+
+async def _collect_stats():
+    return dict(((('stat', key),), value) for key, value in stats().items())
@@ -5,6 +5,7 @@ import pprint
 import bson
 
 from anubis import mq
+from anubis.service import metrics
 from anubis.util import argmethod
 
 __logger = logging.getLogger(__name__)
@@ -49,7 +50,18 @@ async def _work(channel):
 @argmethod.wrap
 async def publish(key: str, value: str):
     channel = await mq.channel('bus')
-    await channel.basic_publish(bson.BSON.encode({'key': key, 'value': value}), 'bus', '')
+    await metrics.observe('mq', channel.basic_publish(bson.BSON.encode({'key': key, 'value': value}),
+                                                      'bus', ''))
+
+
+async def publish_many(key, values):
+    """Publish events of the same key, without waiting for each of them in turn."""
+    if not values:
+        return
+    channel = await mq.channel('bus')
+    await metrics.observe('mq', asyncio.gather(*[
+        channel.basic_publish(bson.BSON.encode({'key': key, 'value': value}), 'bus', '')
+        for value in values]), len(values))
 
 
 def subscribe(callback, keys):
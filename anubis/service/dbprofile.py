@@ -0,0 +1,174 @@
+import asyncio
+import collections
+import logging
+import time
+
+from anubis import redis
+from anubis.service import metrics
+from anubis.util import argmethod
+from anubis.util import json
+from anubis.util import options
+
+options.define('db_profile', default=False, help='Record shapes and timings of database queries.')
+options.define('db_slow_ms', default=100, help='Log queries slower than this with their plan, in milliseconds.')
+
+_logger = logging.getLogger(__name__)
+
+OPERATIONS = ('find', 'find_one', 'find_one_and_update', 'aggregate', 'count')
+
+_REDIS_KEY = 'db-profile'
+
+# Fields of the query shapes returned by top, which they can be sorted by.
+TOP_SORT_FIELDS = ('count', 'ms', 'avg_ms', 'max_ms', 'avg_docs')
+
+_pending = collections.defaultdict(collections.Counter)
+_explained = set()
+
+
+def _shape(value):
+    if isinstance(value, dict):
+        return collections.OrderedDict((k, _shape(v)) for k, v in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(v, (dict, list, tuple)) for v in value):
+            return [_shape(v) for v in value]
+        return ['?']
+    return '?'
+
+
+def get_query(collection, op, args, kwargs):
+    """Bind the arguments of a collection method to a query description."""
+    if op == 'aggregate':
+        names = ['pipeline']
+    elif op == 'find_one_and_update':
+        names = ['filter', 'update']
+    else:
+        names = ['filter', 'projection']
+    query = dict(zip(names, args))
+    query.update(kwargs)
+    if 'filter' in query and query['filter'] is not None and not isinstance(query['filter'], dict):
+        query['filter'] = {'_id': query['filter']}
+    query['collection'] = collection
+    query['op'] = op
+    return query
+
+
+def get_shape(query):
+    """Normalize a query description to its shape, with every value replaced by '?'."""
+    return json.encode(collections.OrderedDict([
+        ('ns', '{0}.{1}'.format(query['collection'].name, query['op'])),
+        ('filter', _shape(query.get('pipeline') or query.get('filter') or {})),
+        ('projection', query.get('projection')),
+        ('sort', query.get('sort')),
+    ]))
+
+
+def record(query, seconds, num_docs):
+    shape = get_shape(query)
+    ms = seconds * 1000
+    stats = _pending[shape]
+    stats['count'] += 1
+    stats['ms'] += ms
+    stats['max_ms'] = max(stats['max_ms'], ms)
+    stats['docs'] += num_docs
+    if ms >= options.options.db_slow_ms and shape not in _explained:
+        _explained.add(shape)
+        asyncio.ensure_future(_log_slow(query, shape, ms))
+
+
+async def profile(awaitable, query):
+    """Await a collection call, recording its time and number of returned documents."""
+    start = time.perf_counter()
+    result = await metrics.observe('mongo', awaitable)
+    if query['op'] == 'count':
+        num_docs = 0
+    elif isinstance(result, list):
+        num_docs = len(result)
+    else:
+        num_docs = 1 if result else 0
+    record(query, time.perf_counter() - start, num_docs)
+    return result
+
+
+async def _explain(query):
+    coll = query['collection']
+    if query['op'] == 'aggregate':
+        return await coll.database.command('aggregate', coll.name, pipeline=query['pipeline'], explain=True)
+    cursor = coll.find(query.get('filter'), query.get('projection'))
+    if query.get('sort'):
+        cursor = cursor.sort(query['sort'])
+    return await cursor.explain()
+
+
+async def _log_slow(query, shape, ms):
+    try:
+        plan = await _explain(query)
+        plan = plan.get('queryPlanner', {}).get('winningPlan', plan)
+    except Exception as e:
+        plan = repr(e)
+    _logger.warning('Slow query (%.1fms): %s\nPlan: %s', ms, shape, plan)
+
+
+async def flush():
+    """Add the pending query statistics of this worker to the shared statistics in Redis."""
+    global _pending
+    if not _pending:
+        return
+    pending, _pending = _pending, collections.defaultdict(collections.Counter)
+    db = await redis.database()
+    commands = []
+    for shape, stats in pending.items():
+        for stat in ['count', 'ms', 'docs']:
+            commands.append(('hincrbyfloat', _REDIS_KEY, shape + '\t' + stat, stats[stat]))
+    await db.pipeline(*commands)
+    # Maximum is not additive, keep the larger one on a best effort basis.
+    old_maxes = await db.pipeline(*[('hget', _REDIS_KEY, shape + '\tmax_ms') for shape in pending])
+    await db.pipeline(*[('hset', _REDIS_KEY, shape + '\tmax_ms', stats['max_ms'])
+                        for (shape, stats), old_max in zip(pending.items(), old_maxes)
+                        if not old_max or float(old_max) < stats['max_ms']])
+
+
+async def _flush_forever():
+    while True:
+        await asyncio.sleep(options.options.metrics_flush_seconds)
+        try:
+            await flush()
+        except Exception as e:
+            _logger.warning('Failed to flush query profile: %s', repr(e))
+
+
+def init():
+    if options.options.db_profile:
+        asyncio.get_event_loop().create_task(_flush_forever())
+
+
+@argmethod.wrap
+async def top(n: int=20, sort_by: str='ms'):
+    """Get the top query shapes of all workers, sorted by one of TOP_SORT_FIELDS."""
+    if sort_by not in TOP_SORT_FIELDS:
+        raise ValueError('sort_by must be one of {0}, not {1!r}'.format(', '.join(TOP_SORT_FIELDS), sort_by))
+    db = await redis.database()
+    shapes = collections.defaultdict(dict)
+    for field, value in (await db.hgetall(_REDIS_KEY)).items():
+        shape, stat = field.decode().rsplit('\t', 1)
+        shapes[shape][stat] = float(value)
+    result = []
+    for shape, stats in shapes.items():
+        count = stats.get('count', 0)
+        result.append({'shape': shape,
+                       'count': int(count),
+                       'ms': round(stats.get('ms', 0), 1),
+                       'avg_ms': round(stats.get('ms', 0) / count, 1) if count else 0,
+                       'max_ms': round(stats.get('max_ms', 0), 1),
+                       'avg_docs': round(stats.get('docs', 0) / count, 1) if count else 0})
+    result.sort(key=lambda e: e[sort_by], reverse=True)
+    return result[:n]
+
+
+@argmethod.wrap
+async def reset():
+    db = await redis.database()
+    return await db.delete(_REDIS_KEY)
+
+
+if __name__ == '__main__':
+    argmethod.invoke_by_args()
@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import time
+
+from anubis.util import options
+
+try:
+    if sys.version_info < (3, 7):
+        # Tasks only run in their own context with the backport patched into asyncio.
+        import aiocontextvars  # noqa
+    import contextvars
+except ImportError:
+    contextvars = None
+
+options.define('metrics_flush_seconds', default=10,
+               help='Interval of flushing metrics of this worker to Redis, in seconds.')
+
+_logger = logging.getLogger(__name__)
+
+BACKENDS = ('mongo', 'redis', 'mq')
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# Metric family name -> (type, help).
+FAMILIES = collections.OrderedDict([
+    ('anubis_http_requests_total', ('counter', 'Number of HTTP requests by route and status.')),
+    ('anubis_http_request_duration_seconds', ('histogram', 'Latency of HTTP requests by route.')),
+    ('anubis_backend_calls_total', ('counter', 'Number of backend calls made by requests of a route.')),
+    ('anubis_backend_call_duration_seconds_total',
+     ('counter', 'Total time of backend calls made by requests of a route.')),
+    ('anubis_queue_wait_seconds', ('histogram', 'Time messages wait in a queue before delivery.')),
+])
+
+# Gauge family name -> coroutine function returning dict of labels tuple -> value, read on render.
+_gauges = collections.OrderedDict()
+
+_REDIS_KEY = 'metrics'
+_SUFFIXES = ('_bucket', '_sum', '_count')
+
+_pending = collections.Counter()
+_scope = contextvars.ContextVar('metrics_scope', default=None) if contextvars else None
+
+
+def _sample(family, **labels):
+    return '{0}{{{1}}}'.format(family, ','.join('{0}="{1}"'.format(k, v) for k, v in sorted(labels.items())))
+
+
+def _route_name(request):
+    name = request.match_info.route.name or ''
+    if name.endswith('_with_domain_id'):
+        name = name[:-len('_with_domain_id')]
+    return name
+
+
+def record_call(backend, seconds, calls=1):
+    """Attribute a backend call to the request being handled, if any."""
+    scope = _scope.get() if _scope else None
+    if scope is not None:
+        scope[backend, 'calls'] += calls
+        scope[backend, 'seconds'] += seconds
+
+
+async def observe(backend, awaitable, calls=1):
+    """Await a backend call and record its time."""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        record_call(backend, time.perf_counter() - start, calls)
+
+
+def record_histogram(family, seconds, **labels):
+    for le in DURATION_BUCKETS:
+        if seconds <= le:
+            _pending[_sample(family + '_bucket', le='+Inf' if le == float('inf') else le, **labels)] += 1
+    _pending[_sample(family + '_sum', **labels)] += seconds
+    _pending[_sample(family + '_count', **labels)] += 1
+
+
+def add_gauge(family, help, collect):
+    """Add a gauge family, whose samples are collected when rendering.
+
+    Args:
+        family: name of the metric family.
+        help: help text of the metric family.
+        collect: coroutine function returning a dict of labels dict as tuple of (name, value)
+            pairs -> value.
+    """
+    FAMILIES[family] = ('gauge', help)
+    _gauges[family] = collect
+
+
+def record_request(route, status, seconds, scope=None):
+    _pending[_sample('anubis_http_requests_total', route=route, status=status)] += 1
+    record_histogram('anubis_http_request_duration_seconds', seconds, route=route)
+    if scope:
+        for backend in BACKENDS:
+            if scope[backend, 'calls']:
+                _pending[_sample('anubis_backend_calls_total', route=route, backend=backend)] += \
+                    scope[backend, 'calls']
+                _pending[_sample('anubis_backend_call_duration_seconds_total', route=route, backend=backend)] += \
+                    scope[backend, 'seconds']
+
+
+async def middleware(app, handler):
+    async def wrapped(request):
+        scope = collections.Counter()
+        token = _scope.set(scope) if _scope else None
+        start, status = time.perf_counter(), 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except Exception as e:
+            status = getattr(e, 'status', 500)
+            raise
+        finally:
+            record_request(_route_name(request), status, time.perf_counter() - start, scope)
+            if token is not None:
+                _scope.reset(token)
+
+    return wrapped
+
+
+async def flush():
+    """Add the pending metrics of this worker to the shared counters in Redis."""
+    global _pending
+    if not _pending:
+        return
+    from anubis import redis
+    pending, _pending = _pending, collections.Counter()
+    try:
+        db = await redis.database()
+        await db.pipeline(*[('hincrbyfloat', _REDIS_KEY, field, value) for field, value in pending.items()])
+    except Exception:
+        _pending.update(pending)
+        raise
+
+
+async def _flush_forever():
+    while True:
+        await asyncio.sleep(options.options.metrics_flush_seconds)
+        try:
+            await flush()
+        except Exception as e:
+            _logger.warning('Failed to flush metrics of worker %d: %s', os.getpid(), repr(e))
+
+
+def init():
+    if not contextvars:
+        _logger.warning('contextvars is not available, backend calls are not attributed to routes. '
+                        'Install aiocontextvars on Python < 3.7.')
+    asyncio.get_event_loop().create_task(_flush_forever())
+
+
+async def render():
+    """Render the metrics of all workers in the Prometheus text format."""
+    from anubis import redis
+    await flush()
+    db = await redis.database()
+    samples = dict((field.decode(), float(value))
+                   for field, value in (await db.hgetall(_REDIS_KEY)).items())
+    for family, collect in _gauges.items():
+        try:
+            for labels, value in (await collect()).items():
+                samples[_sample(family, **dict(labels))] = float(value)
+        except Exception as e:
+            _logger.warning('Failed to collect %s: %s', family, repr(e))
+    by_family = collections.defaultdict(list)
+    for field in sorted(samples):
+        family = field.split('{', 1)[0]
+        for suffix in _SUFFIXES:
+            if family.endswith(suffix) and family[:-len(suffix)] in FAMILIES:
+                family = family[:-len(suffix)]
+                break
+        by_family[family].append(field)
+    lines = []
+    for family, (family_type, family_help) in FAMILIES.items():
+        lines.append('# HELP {0} {1}'.format(family, family_help))
+        lines.append('# TYPE {0} {1}'.format(family, family_type))
+        for field in by_family[family]:
+            lines.append('{0} {1}'.format(field, repr(samples[field])))
+    return '\n'.join(lines) + '\n'
@@ -1,20 +1,44 @@
 import collections
 import copy
+import time
 
 from anubis.service import bus
 from anubis.util import options
 
 PREFIX_DISCUSSION_NODES = 'discussion-nodes-'
+PREFIX_DOMAIN = 'domain-'
+PREFIX_ANSWER = 'answer-'
 
 options.define('smallcache_max_entries', default=64,
                help='Maximum number of entries of smallcache.')
+options.define('smallcache_domain_max_entries', default=256,
+               help='Maximum number of domains in smallcache.')
+options.define('smallcache_domain_expire_seconds', default=60,
+               help='Time a domain is kept in smallcache, in seconds.')
+options.define('smallcache_answer_max_entries', default=1024,
+               help='Maximum number of answer digests in smallcache.')
 
-_cache = collections.OrderedDict()
+# Prefix of keys -> (option of the maximum number of entries, option of the expire seconds or None).
+# Keys of other prefixes share the default namespace.
+_NAMESPACES = {
+    PREFIX_DOMAIN: ('smallcache_domain_max_entries', 'smallcache_domain_expire_seconds'),
+    PREFIX_ANSWER: ('smallcache_answer_max_entries', None),
+}
+_DEFAULT_NAMESPACE = ('smallcache_max_entries', None)
+
+_caches = collections.defaultdict(collections.OrderedDict)  # prefix -> key -> (value, expire_at)
+
+
+def _get_cache(key):
+    """Get the namespace of a key and its entries, so that namespaces do not evict each other."""
+    for prefix, namespace in _NAMESPACES.items():
+        if key.startswith(prefix):
+            return namespace, _caches[prefix]
+    return _DEFAULT_NAMESPACE, _caches['']
 
 
 async def _on_unset(e):
-    if e['value'] in _cache:
-        del _cache[e['value']]
+    unset_local(e['value'])
 
 
 def init():
@@ -22,10 +46,15 @@ def init():
 
 
 def get_direct(key, default=None):
-    if key not in _cache:
+    _, cache = _get_cache(key)
+    if key not in cache:
         return default
-    _cache.move_to_end(key)
-    return _cache[key]
+    value, expire_at = cache[key]
+    if expire_at is not None and expire_at <= time.monotonic():
+        del cache[key]
+        return default
+    cache.move_to_end(key)
+    return value
 
 
 def get(key, default=None):
@@ -33,21 +62,32 @@ def get(key, default=None):
 
 
 def set_local_direct(key, value):
-    if key in _cache:
-        del _cache[key]
-    _cache[key] = value
-    if len(_cache) > options.smallcache_max_entries:
-        _cache.popitem(False)
+    (max_entries_option, expire_seconds_option), cache = _get_cache(key)
+    if key in cache:
+        del cache[key]
+    expire_at = None
+    if expire_seconds_option:
+        expire_at = time.monotonic() + getattr(options.options, expire_seconds_option)
+    cache[key] = value, expire_at
+    if len(cache) > getattr(options.options, max_entries_option):
+        cache.popitem(False)
 
 
 def set_local(key, value):
     set_local_direct(key, copy.deepcopy(value))
 
 
+def unset_local(key):
+    _, cache = _get_cache(key)
+    if key in cache:
+        del cache[key]
+
+
 async def unset_global(key):
+    unset_local(key)
     await bus.publish('smallcache-unset', key)
 
 
 def uninit():
     bus.unsubscribe(_on_unset)
-    _cache.clear()
+    _caches.clear()
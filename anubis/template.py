@@ -1,3 +1,5 @@
+import collections
+import functools
 import hashlib
 import misaka
 from os import path
@@ -12,6 +14,12 @@ import anubis
 from anubis.util import json
 from anubis.util import options
 
+options.define('template_cache_dir', default='',
+               help='Template bytecode cache directory shared by workers, empty for a temp directory.')
+options.define('template_precompile', default=False, help='Compile all templates on startup.')
+options.define('markdown_cache_bytes', default=32 * 1024 * 1024,
+               help='Maximum size of rendered markdown kept in memory, in bytes.')
+
 
 class Undefined(jinja2.runtime.Undefined):
 
@@ -24,13 +32,13 @@ class Environment(jinja2.Environment):
     def __init__(self):
         super(Environment, self).__init__(
             loader=jinja2.FileSystemLoader(path.join(path.dirname(__file__), 'ui/templates')),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(options.options.template_cache_dir or None),
             extensions=[jinja2.ext.with_],
             auto_reload=options.options.debug,
             autoescape=True,
             trim_blocks=True,
             undefined=Undefined
         )
-        globals()[self.__class__.__name__] = lambda: self
 
         self.globals['anubis'] = anubis
         self.globals['static_url'] = lambda s: options.options.cdn_prefix + s
@@ -41,6 +49,26 @@ class Environment(jinja2.Environment):
         self.filters['gravatar_url'] = gravatar_url
         self.filters['to_size'] = to_size
 
+    def precompile(self):
+        """Load every template, so that no request pays the compile cost.
+
+        Returns:
+            Number of templates loaded.
+        """
+        names = self.list_templates(extensions=['html'])
+        for name in names:
+            self.get_template(name)
+        return len(names)
+
+
+@functools.lru_cache()
+def get_environment():
+    """Get the environment shared by the process, so that compiled templates are kept in memory.
+
+    Created on first use, after all options are defined.
+    """
+    return Environment()
+
 
 MARKDOWN_EXTENSIONS = (
     misaka.EXT_TABLES |                # Parse PHP-Markdown style tables.
@@ -57,10 +85,32 @@ MARKDOWN_RENDER_FLAGS = (
 )
 
 
+_markdown_cache = collections.OrderedDict()
+_markdown_cache_bytes = 0
+
+
 def markdown(text):
-    return markupsafe.Markup(
+    """Render markdown, reusing the result for the same text and flags.
+
+    Rendered HTML is kept in a least recently used cache keyed by the digest of the text,
+    bounded by markdown_cache_bytes.
+    """
+    global _markdown_cache_bytes
+    key = (hashlib.sha1(text.encode()).digest(), MARKDOWN_EXTENSIONS, MARKDOWN_RENDER_FLAGS)
+    if key in _markdown_cache:
+        _markdown_cache.move_to_end(key)
+        return _markdown_cache[key][0]
+    html = markupsafe.Markup(
         misaka.html(text, extensions=MARKDOWN_EXTENSIONS, render_flags=MARKDOWN_RENDER_FLAGS)
     )
+    size = len(html.encode())
+    if size <= options.options.markdown_cache_bytes:
+        _markdown_cache[key] = html, size
+        _markdown_cache_bytes += size
+        while _markdown_cache_bytes > options.options.markdown_cache_bytes:
+            _, (_, evicted_size) = _markdown_cache.popitem(False)
+            _markdown_cache_bytes -= evicted_size
+    return html
 
 
 def gravatar_url(gravatar, size=200):
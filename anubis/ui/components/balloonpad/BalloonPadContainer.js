@@ -14,11 +14,22 @@ const mapStateToProps = (state, ownProps) => ({
     sent: state.sent,
 });
 
+async function getPendingBalloons() {
+    const balloons = [];
+    let cursor = null;
+    do {
+        const data = await util.get('', cursor ? { after: cursor } : {});
+        balloons.push(...data.balloons);
+        cursor = data.cursor;
+    } while (cursor);
+    return { balloons };
+}
+
 const mapDispatchToProps = dispatch => ({
     loadBalloons() {
         dispatch({
             type: 'BALLOON_LOAD',
-            payload: util.get(''),
+            payload: getPendingBalloons(),
         });
     },
 });
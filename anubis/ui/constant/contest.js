@@ -8,13 +8,13 @@ export const COUNT_SILVER = 6;
 export const COUNT_BRONZE = 9;
 
 export const RULE_ID = {
-  //[RULE_OI]: 'oi',
+  [RULE_OI]: 'oi',
   [RULE_ACM]: 'acm',
 };
 attachObjectMeta(RULE_ID, 'intKey', true);
 
 export const RULE_TEXTS = {
-  //[RULE_OI]: 'OI',
+  [RULE_OI]: 'OI',
   [RULE_ACM]: 'ACM/ICPC',
 };
 attachObjectMeta(RULE_TEXTS, 'intKey', true);
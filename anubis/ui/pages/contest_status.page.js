@@ -6,11 +6,40 @@ import { NamedPage } from '../misc/PageLoader';
 const page = new NamedPage('contest_status', async () => {
     const SockJs = await System.import('sockjs-client');
     const sock = new SockJs(`/contest/${Context.tid}/notification-conn`);
+    const revs = {};
+
+    function highlight() {
+        $(`.data-table tr[data-uid="${UserContext.uid}"]`).addClass('highlight');
+    }
+
+    highlight();
 
     sock.onmessage = message => {
         const msg = JSON.parse(message.data);
         if (msg.type === 'rank_changed') {
             window.location.reload();
+        } else if (msg.type === 'row_changed') {
+            // Skip deltas already in the page or older than the last one of the same team.
+            if (msg.rev <= Math.max(Context.rev, revs[msg.uid] || 0)) {
+                return;
+            }
+            revs[msg.uid] = msg.rev;
+            const $tbody = $('.data-table tbody');
+            $tbody.children(`tr[data-uid="${msg.uid}"]`).remove();
+            const $rows = $tbody.children('tr');
+            if (msg.position <= $rows.length) {
+                $(msg.html).insertBefore($rows.eq(msg.position - 1));
+            } else {
+                $tbody.append(msg.html);
+            }
+            for (const rank of msg.ranks) {
+                const $rank = $tbody.find(`tr[data-uid="${rank.uid}"] .col--rank`);
+                $rank.text(rank.rank).removeClass('back-gold back-silver back-bronze');
+                if (rank.prize) {
+                    $rank.addClass(`back-${rank.prize}`);
+                }
+            }
+            highlight();
         }
     };
 });
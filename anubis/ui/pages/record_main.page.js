@@ -4,7 +4,7 @@ const page = new NamedPage('record_main', async() => {
     const SockJs = await System.import('sockjs-client');
     const DiffDOM = await System.import('diff-dom');
 
-    const sock = new SockJs('/records-conn');
+    const sock = new SockJs(`/records-conn${window.location.search}`);
     const dd = new DiffDOM();
 
     sock.onmessage = (message) => {
@@ -0,0 +1,53 @@
+import asyncio
+
+
+class DataLoader(object):
+    """Batch loader with an identity map.
+
+    Every key loaded in the same event loop tick is collected and fetched by a single call to
+    batch_func. Loaded documents are cached by key, so repeated loads return the same document
+    without another round trip. The cache lives as long as the loader, so create one per request.
+
+    Args:
+        batch_func: coroutine function taking a list of keys and returning a dict of key to doc.
+    """
+
+    def __init__(self, batch_func):
+        self._batch_func = batch_func
+        self._futures = {}
+        self._queue = []
+
+    def load(self, key):
+        """Load a key. Returns a future of the document, or None if not found."""
+        if key in self._futures:
+            return self._futures[key]
+        future = asyncio.Future()
+        self._futures[key] = future
+        self._queue.append((key, future))
+        if len(self._queue) == 1:
+            asyncio.get_event_loop().call_soon(self._dispatch)
+        return future
+
+    async def load_many(self, keys):
+        """Load a list of keys. Returns a dict of key to document."""
+        keys = list(keys)
+        docs = await asyncio.gather(*[self.load(key) for key in keys])
+        return dict((key, doc) for key, doc in zip(keys, docs) if doc is not None)
+
+    def _dispatch(self):
+        queue, self._queue = self._queue, []
+        asyncio.ensure_future(self._batch(queue))
+
+    async def _batch(self, queue):
+        try:
+            result = await self._batch_func([key for key, _ in queue])
+        except Exception as e:
+            for key, future in queue:
+                if self._futures.get(key) is future:
+                    del self._futures[key]
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in queue:
+            if not future.done():
+                future.set_result(result.get(key))
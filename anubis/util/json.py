@@ -4,6 +4,24 @@ import json
 
 from bson import objectid
 
+from anubis.util import argmethod
+from anubis.util import options
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+options.define('json_backend', default='auto', help='JSON backend, "auto", "orjson" or "stdlib".')
+
+
+def _default(o):
+    if type(o) is objectid.ObjectId:
+        return str(o)
+    if type(o) is datetime.datetime:
+        return calendar.timegm(o.utctimetuple()) * 1000
+    raise TypeError(repr(o) + ' is not JSON serializable')
+
 
 class Encoder(json.JSONEncoder):
     item_separator = ','
@@ -13,15 +31,102 @@ class Encoder(json.JSONEncoder):
         super(Encoder, self).__init__(ensure_ascii=False)
 
     def default(self, o):
-        if type(o) is objectid.ObjectId:
-            return str(o)
-        if type(o) is datetime.datetime:
-            return calendar.timegm(o.utctimetuple()) * 1000
-        return super(Encoder, self).default(o)
+        try:
+            return _default(o)
+        except TypeError:
+            return super(Encoder, self).default(o)
 
 
 class Decoder(json.JSONDecoder):
     pass
 
-encode = Encoder().encode
-decode = Decoder().decode
+
+_stdlib_encode = Encoder().encode
+_stdlib_decode = Decoder().decode
+
+
+_CONTAINER_TYPES = (dict, list, tuple)
+
+
+def _has_float_differing(obj):
+    """Whether obj has a float orjson encodes differently from the stdlib.
+
+    orjson encodes non-finite floats as null, and exponents without a sign and padding, e.g. 1e16
+    for 1e+16. The stdlib writes exponents for floats below 1e-4 or from 1e16 in magnitude.
+    Subclasses of the containers, e.g. OrderedDict and defaultdict, are looked into as well.
+    """
+    if isinstance(obj, float):
+        return not (1e-4 <= abs(obj) < 1e16 or obj == 0.0)
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, _CONTAINER_TYPES):
+        return False
+    for value in obj:
+        if isinstance(value, (float, *_CONTAINER_TYPES)) and _has_float_differing(value):
+            return True
+    return False
+
+
+def _orjson_encode(obj):
+    if _has_float_differing(obj):
+        return _stdlib_encode(obj)
+    try:
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS).decode()
+    except TypeError:
+        # Values orjson refuses, e.g. integers wider than 64 bits.
+        return _stdlib_encode(obj)
+
+
+def _orjson_decode(s):
+    try:
+        return orjson.loads(s)
+    except ValueError:
+        return _stdlib_decode(s)
+
+
+if options.options.json_backend == 'orjson' and not orjson:
+    raise ImportError('json_backend is orjson, but orjson is not installed')
+if options.options.json_backend == 'orjson' or (options.options.json_backend == 'auto' and orjson):
+    encode, decode = _orjson_encode, _orjson_decode
+else:
+    encode, decode = _stdlib_encode, _stdlib_decode
+
+
+@argmethod.wrap
+def benchmark(number: int=10000):
+    """Compare the JSON backends on session, record and scoreboard documents."""
+    import timeit
+    now = datetime.datetime.utcnow()
+    session = {'_id': 'f' * 64, 'token_type': 2, 'uid': 1001, 'create_at': now, 'update_at': now,
+               'expire_at': now, 'create_ip': '10.0.0.1', 'update_ip': '10.0.0.1',
+               'update_ua': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 Chrome/56.0 Safari/537.36'}
+    record = {'_id': objectid.ObjectId(), 'hidden': False, 'status': 1, 'time_ms': 1234,
+              'memory_kb': 65536, 'domain_id': 'system', 'pid': 1001, 'uid': 1001, 'lang': 'cc',
+              'tid': None, 'data_id': None, 'type': 1, 'judge_uid': 1, 'judge_at': now,
+              'compiler_texts': ['foo.cc: In function ‘int main()’:'], 'judge_texts': [],
+              'cases': [{'status': 1, 'time_ms': 12, 'memory_kb': 1024, 'judge_text': ''}] * 50}
+    scoreboard = [{'_id': objectid.ObjectId(), 'domain_id': 'system', 'tid': 1001, 'uid': 1000 + i,
+                   'attend': 1, 'rev': 20, 'accept': 8, 'time': 123456.0,
+                   'journal': [{'rid': objectid.ObjectId(), 'pid': 1000 + j, 'accept': j % 2 == 0}
+                               for j in range(13)],
+                   'detail': [{'rid': objectid.ObjectId(), 'pid': 1000 + j, 'accept': True, 'naccept': 1,
+                               'time': 3600.0, 'balloon': False} for j in range(13)]}
+                  for i in range(500)]
+    backends = [('stdlib', _stdlib_encode, _stdlib_decode)]
+    if orjson:
+        backends.append(('orjson', _orjson_encode, _orjson_decode))
+    for name, payload, payload_number in [('session', session, number),
+                                          ('record', record, number),
+                                          ('scoreboard', scoreboard, max(number // 100, 1))]:
+        expected = _stdlib_encode(payload)
+        for backend, backend_encode, backend_decode in backends:
+            assert backend_encode(payload) == expected, backend
+            encode_secs = timeit.timeit(lambda: backend_encode(payload), number=payload_number)
+            decode_secs = timeit.timeit(lambda: backend_decode(expected), number=payload_number)
+            print('{0:<12}{1:<8}encode {2:9.2f} us  decode {3:9.2f} us'.format(
+                name, backend, encode_secs / payload_number * 1e6, decode_secs / payload_number * 1e6))
+
+
+if __name__ == '__main__':
+    argmethod.invoke_by_args()
@@ -0,0 +1,240 @@
+import calendar
+import collections
+import itertools
+import operator
+import time
+
+from anubis.util import argmethod
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ACM_PENALTY_SECONDS = 20 * 60
+
+# Effective submission of a cell: the first accepted one, or the last one if none is accepted.
+EFFECTIVE_FIRST_ACCEPT = 'first_accept'
+# Effective submission of a cell: the last one.
+EFFECTIVE_LAST = 'last'
+# Effective submission of a cell: the one with the maximum score, the last one among ties.
+EFFECTIVE_BEST = 'best'
+
+# Submissions of a contest flattened into columns, in the order of journals.
+Columns = collections.namedtuple('Columns', ['team', 'problem', 'rid', 'accept', 'score', 'jdocs'])
+
+# Effective submission of each cell (team, problem) with a submission, ordered by team and then by
+# problem. Row is the index of the submission in the columns, naccept is the number of rejected
+# submissions before it, and time is the seconds since the beginning of the contest plus penalty.
+Cells = collections.namedtuple('Cells', ['team', 'problem', 'row', 'naccept', 'time', 'accept', 'score'])
+
+
+def _journal_key(jdoc):
+    return jdoc['rid']
+
+
+def uniquify_journal(journal):
+    """Sort a journal by rid, keeping the last entry of each rid."""
+    # Journals are stored uniquified, which is checked on the bytes of rids, compared in C rather than
+    # by ObjectId.__lt__.
+    rids = [jdoc['rid'].binary for jdoc in journal]
+    if all(map(operator.lt, rids, rids[1:])):
+        return list(journal)
+    return [list(g)[-1] for _, g in itertools.groupby(sorted(journal, key=_journal_key), key=_journal_key)]
+
+
+def _get_columns(tdoc, journals):
+    pindex = dict((pid, index) for index, pid in enumerate(tdoc['pids']))
+    team, problem, rid, jdocs = [], [], [], []
+    for index, journal in enumerate(journals):
+        for jdoc in journal:
+            if jdoc['pid'] in pindex:
+                team.append(index)
+                problem.append(pindex[jdoc['pid']])
+                rid.append(jdoc['rid'].binary)
+                jdocs.append(jdoc)
+    return Columns(team=team, problem=problem, rid=rid, accept=[bool(jdoc['accept']) for jdoc in jdocs],
+                   score=[jdoc.get('score', 0) for jdoc in jdocs], jdocs=jdocs)
+
+
+def _get_begin_at(tdoc):
+    return calendar.timegm(tdoc['begin_at'].utctimetuple()) + tdoc['begin_at'].microsecond / 1000000
+
+
+def _get_cells_numpy(tdoc, columns, effective_mode):
+    team = numpy.array(columns.team, dtype=numpy.int64)
+    problem = numpy.array(columns.problem, dtype=numpy.int64)
+    accept = numpy.array(columns.accept, dtype=numpy.bool_)
+    score = numpy.array(columns.score, dtype=numpy.float64)
+    # An ObjectId is 3 big-endian words, the first being its generation time in seconds.
+    rid = numpy.frombuffer(b''.join(columns.rid), dtype='>u4').reshape(-1, 3).astype(numpy.int64)
+    # Uniquify journals: sort by team and rid, keeping the last entry of each rid. Journals are
+    # stored uniquified, so the sort is skipped when rows are in order already. The sorts are stable,
+    # so that entries of the same rid stay in the order of journals.
+    diff = numpy.diff(numpy.column_stack((team, rid)), axis=0)
+    nonzero = diff != 0
+    first_nonzero = numpy.where(nonzero.any(axis=1), nonzero.argmax(axis=1), 0)
+    if (diff[numpy.arange(len(diff)), first_nonzero] > 0).all():
+        row = numpy.arange(len(team))
+    else:
+        row = numpy.lexsort((rid[:, 2], rid[:, 1], team << 32 | rid[:, 0]))
+        same = (team[row][1:] == team[row][:-1]) & (rid[row][1:] == rid[row][:-1]).all(axis=1)
+        row = row[numpy.append(~same, True)]
+    # Group rows into cells, keeping the order of rid in a cell. For the best score, the last row
+    # of a cell becomes the last one with the maximum score.
+    num_problems = len(tdoc['pids'])
+    if effective_mode == EFFECTIVE_BEST:
+        row = row[numpy.lexsort((score[row], team[row] * num_problems + problem[row]))]
+    else:
+        row = row[numpy.argsort(team[row] * num_problems + problem[row], kind='stable')]
+    cell = team[row] * num_problems + problem[row]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], cell[1:] != cell[:-1])))
+    sizes = numpy.diff(numpy.append(starts, len(row)))
+    effective = starts + sizes - 1
+    naccept = sizes.copy()
+    if effective_mode == EFFECTIVE_FIRST_ACCEPT:
+        accepted = numpy.flatnonzero(accept[row])
+        if len(accepted):
+            # The first accepted row of each cell, with only rejected rows before it.
+            accepted_cells, first = numpy.unique(cell[accepted], return_index=True)
+            index = numpy.searchsorted(cell[starts], accepted_cells)
+            effective[index] = accepted[first]
+            naccept[index] = accepted[first] - starts[index]
+    effective = row[effective]
+    time = rid[effective, 0] - _get_begin_at(tdoc) + naccept * ACM_PENALTY_SECONDS
+    rows = effective.tolist()
+    return Cells(team=team[effective].tolist(),
+                 problem=problem[effective].tolist(),
+                 row=rows,
+                 naccept=naccept.tolist(),
+                 time=time.tolist(),
+                 accept=accept[effective].tolist(),
+                 score=[columns.score[i] for i in rows])
+
+
+def _get_cells_python(tdoc, columns, effective_mode):
+    begin_at = _get_begin_at(tdoc)
+    team_rid_key = lambda i: (columns.team[i], columns.rid[i])
+    rows = collections.OrderedDict()
+    for _, g in itertools.groupby(sorted(range(len(columns.jdocs)), key=team_rid_key), key=team_rid_key):
+        index = list(g)[-1]
+        rows.setdefault((columns.team[index], columns.problem[index]), []).append(index)
+    cells = Cells([], [], [], [], [], [], [])
+    for (team, problem), indices in sorted(rows.items()):
+        naccept = len(indices)
+        if effective_mode == EFFECTIVE_BEST:
+            effective = max(reversed(indices), key=lambda i: columns.score[i])
+        elif effective_mode == EFFECTIVE_LAST:
+            effective = indices[-1]
+        else:
+            effective = next((i for i in indices if columns.accept[i]), indices[-1])
+            if columns.accept[effective]:
+                naccept = indices.index(effective)
+        rid_time = int.from_bytes(columns.rid[effective][:4], 'big')
+        cells.team.append(team)
+        cells.problem.append(problem)
+        cells.row.append(effective)
+        cells.naccept.append(naccept)
+        cells.time.append(rid_time - begin_at + naccept * ACM_PENALTY_SECONDS)
+        cells.accept.append(columns.accept[effective])
+        cells.score.append(columns.score[effective])
+    return cells
+
+
+def get_cells(tdoc, journals, effective_mode=EFFECTIVE_FIRST_ACCEPT):
+    """Get the effective submission of each team and problem of a contest.
+
+    Journals are uniquified by rid first, and entries of problems not in the contest are ignored.
+    Uses NumPy if it is installed.
+
+    Args:
+        tdoc: the contest.
+        journals: list of journals of teams, the index of a journal is the team of its cells.
+        effective_mode: one of EFFECTIVE_*.
+
+    Returns:
+        The columns of submissions and the cells.
+    """
+    columns = _get_columns(tdoc, journals)
+    if numpy and columns.jdocs:
+        return columns, _get_cells_numpy(tdoc, columns, effective_mode)
+    else:
+        return columns, _get_cells_python(tdoc, columns, effective_mode)
+
+
+def acm_stats(tdoc, journals):
+    """Compute ACM stats of teams of a contest from their journals.
+
+    Returns:
+        List of stats of teams in the order of journals, each like contest._acm_stat with details in
+        the order of problems.
+    """
+    columns, cells = get_cells(tdoc, journals)
+    stats = [{'accept': 0, 'time': 0, 'detail': []} for _ in journals]
+    for team, row, naccept, cell_time, accept in zip(
+            cells.team, cells.row, cells.naccept, cells.time, cells.accept):
+        stat = stats[team]
+        stat['detail'].append({**columns.jdocs[row], 'naccept': naccept, 'time': cell_time})
+        if accept:
+            stat['accept'] += 1
+            stat['time'] += cell_time
+    return stats
+
+
+def acm_first_bloods(tdoc, journals):
+    """Get the first team to solve each problem of a contest.
+
+    Returns:
+        Dict of pid -> index of the journal of the team.
+    """
+    columns, cells = get_cells(tdoc, journals)
+    first = {}
+    for team, problem, row, accept in zip(cells.team, cells.problem, cells.row, cells.accept):
+        rid = columns.jdocs[row]['rid']
+        if accept and (problem not in first or rid < first[problem][0]):
+            first[problem] = (rid, team)
+    return dict((tdoc['pids'][problem], team) for problem, (_, team) in first.items())
+
+
+def oi_stats(tdoc, journals, *, best=False):
+    """Compute OI stats of teams of a contest from their journals, by last or best scores.
+
+    Returns:
+        List of stats of teams in the order of journals, each like contest._oi_stat with details in
+        the order of problems.
+    """
+    columns, cells = get_cells(tdoc, journals, EFFECTIVE_BEST if best else EFFECTIVE_LAST)
+    stats = [{'score': 0, 'detail': []} for _ in journals]
+    for team, row, score in zip(cells.team, cells.row, cells.score):
+        stats[team]['detail'].append(columns.jdocs[row])
+        stats[team]['score'] += score
+    return stats
+
+
+@argmethod.wrap
+def benchmark(num_teams: int=5000, num_problems: int=13, num_submissions: int=200000):
+    """Time a full recompute of ACM and OI stats of a generated contest."""
+    import datetime
+    import os
+    import random
+    from bson import objectid
+    begin_at = datetime.datetime(2017, 1, 1)
+    journals = [[] for _ in range(num_teams)]
+    for _ in range(num_submissions):
+        rid = objectid.ObjectId((1483228800 + random.randrange(18000)).to_bytes(4, 'big') + os.urandom(8))
+        journals[random.randrange(num_teams)].append({'rid': rid, 'pid': random.randrange(num_problems),
+                                                      'accept': random.random() < 0.3,
+                                                      'score': random.randrange(101)})
+    # Journals are stored uniquified.
+    journals = [uniquify_journal(journal) for journal in journals]
+    tdoc = {'pids': list(range(num_problems)), 'begin_at': begin_at}
+    print('backend', 'numpy' if numpy else 'python')
+    for name, func in [('uniquify', lambda tdoc, journals: [uniquify_journal(j) for j in journals]),
+                       ('cells', get_cells), ('acm', acm_stats), ('acm first blood', acm_first_bloods),
+                       ('oi', oi_stats)]:
+        start = time.perf_counter()
+        func(tdoc, journals)
+        print('{0:<16}{1:9.2f} ms'.format(name, (time.perf_counter() - start) * 1000))
+
+if __name__ == '__main__':
+    argmethod.invoke_by_args()
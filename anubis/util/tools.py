@@ -1,3 +1,4 @@
+import importlib
 import logging
 import pkgutil
 from os import path
@@ -10,9 +11,9 @@ _logger = logging.getLogger(__name__)
 @argmethod.wrap
 async def create_all_indexes():
     model_path = path.join(path.dirname(path.dirname(__file__)), 'model')
-    for model_finder, name, isPkg in pkgutil.iter_modules([model_path]):
+    for _, name, isPkg in pkgutil.iter_modules([model_path]):
         if not isPkg:
-            module = model_finder.find_module(name).load_module()
+            module = importlib.import_module('anubis.model.' + name)
             if 'create_indexes' in dir(module):
                 _logger.info('Creating indexes for "%s".' % name)
                 await module.create_indexes()
@@ -0,0 +1,58 @@
+import asyncio
+import time
+import zipfile
+
+
+class _Buffer(object):
+    """Unseekable file collecting what the ZIP file writes, until it is taken."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStreamWriter(object):
+    """Writer of a ZIP archive into a prepared StreamResponse, entry by entry.
+
+    Entries are compressed in the default executor, and written to the response as soon as they are
+    compressed, so that neither the archive is kept in memory nor the event loop is blocked.
+    """
+
+    def __init__(self, response, compression=zipfile.ZIP_DEFLATED):
+        self._response = response
+        self._compression = compression
+        self._buffer = _Buffer()
+        self._zip_file = zipfile.ZipFile(self._buffer, 'w', compression)
+
+    def _write(self, name, data):
+        zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = self._compression
+        zinfo.create_system = 0
+        self._zip_file.writestr(zinfo, data)
+
+    async def _flush(self):
+        data = self._buffer.take()
+        if data:
+            self._response.write(data)
+            await self._response.drain()
+
+    async def write(self, name, data):
+        """Write an entry of str or bytes."""
+        await asyncio.get_event_loop().run_in_executor(None, self._write, name, data)
+        await self._flush()
+
+    async def close(self):
+        """Write the central directory and finish the archive."""
+        await asyncio.get_event_loop().run_in_executor(None, self._zip_file.close)
+        await self._flush()